@@ -0,0 +1,153 @@
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from windowing import build_windows, sliding_windows, HORIZONS
+from evaluation import parse_model_name, denormalize_glucose
+import numpy_engine
+
+# Scores every window of the whole history with the models in models/ and writes predictions next to the actual
+# values to a parquet file, e.g. for retrospective review and drift checks:
+#   python backfill.py --output backfill.parquet --workers 4
+
+INPUT_WIDTH = 20
+CHUNK_SIZE = 65536
+
+# Set in every worker process by _init_worker, so jobs only carry window start indices
+_series = None
+_models = {}
+_columns = {}
+
+
+def _init_worker(series):
+    global _series
+    _series = series
+    _columns.clear()
+
+
+def _score_chunk(job):
+    """
+    :param job: Tuple of model path, input columns (indices into the series) and window start indices
+    :return: Normalized predictions of the windows, float32
+    """
+    model_path, column_indices, starts = job
+    if model_path not in _models:
+        _models[model_path] = numpy_engine.load_model(model_path)
+    key = tuple(column_indices)
+    if key not in _columns:
+        _columns[key] = np.ascontiguousarray(_series[:, column_indices])
+    values = _columns[key]
+    inputs = sliding_windows(values, INPUT_WIDTH)[starts]
+    return _models[model_path].predict(inputs).reshape(len(starts), -1)[:, 0]
+
+
+def history_frame(pipeline):
+    """
+    :return: Normalized train, validation and test splits back to back, i.e. the whole history
+    """
+    train_df, val_df, test_df, _ = pipeline.normalize()
+    return pd.concat([train_df, val_df, test_df])
+
+
+def score_model(executor, model_path, history, series_columns, chunk_size=CHUNK_SIZE):
+    """
+    Scores all valid windows of the history with one model
+    :param executor: ProcessPoolExecutor initialized with the history series, or None to score in this process
+    :return: DataFrame with the window times, normalized actual values and predictions
+    """
+    model_type, horizon, columns = parse_model_name(os.path.splitext(os.path.basename(model_path))[0])
+    shift = HORIZONS[horizon]
+    column_indices = [series_columns.index(column) for column in columns]
+    _, labels, mask = build_windows(history, INPUT_WIDTH, shift, columns=columns,
+                                    label_column=columns.index("Glucose"))
+    starts = np.flatnonzero(mask)
+    jobs = [(model_path, column_indices, starts[i:i + chunk_size]) for i in range(0, len(starts), chunk_size)]
+    if executor is None:
+        predictions = [_score_chunk(job) for job in jobs]
+    else:
+        predictions = list(executor.map(_score_chunk, jobs))
+
+    times = history["Time"].to_numpy()
+    return pd.DataFrame({
+        "model": os.path.splitext(os.path.basename(model_path))[0],
+        "horizon": horizon,
+        # Time of the last input and of the predicted sample
+        "time": times[starts + INPUT_WIDTH - 1],
+        "target_time": times[starts + INPUT_WIDTH + shift - 1],
+        "actual": labels[starts],
+        "predicted": np.concatenate(predictions) if predictions else np.empty(0, dtype=np.float32),
+    })
+
+
+def backfill(model_paths, output, pipeline=None, workers=None, chunk_size=CHUNK_SIZE):
+    """
+    :param model_paths: Paths of the models to score, named <type>_<horizon>_<features>
+    :param output: Parquet file to write
+    :param pipeline: FeaturePipeline providing the normalized history
+    :param workers: Number of scoring processes, defaults to the number of cores
+    :return: DataFrame with the number of scored windows, seconds and windows per second of every model
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from my_functions import FeaturePipeline
+
+    pipeline = pipeline or FeaturePipeline()
+    history = history_frame(pipeline)
+    series_columns = [col for col in history.columns if col != "Time"]
+    series = history[series_columns].to_numpy(dtype=np.float32)
+    scaler_features = [col for col in pipeline.using_features if col != "Time"]
+    glucose_index = scaler_features.index("Glucose")
+
+    workers = workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(series,)) \
+        if workers > 1 else None
+    if executor is None:
+        _init_worker(series)
+
+    writer = None
+    stats = []
+    try:
+        for model_path in model_paths:
+            model_start = time.perf_counter()
+            scored = score_model(executor, model_path, history, series_columns, chunk_size)
+            scored["actual_mgdl"] = denormalize_glucose(scored["actual"].to_numpy(), pipeline.min_max_scaler, glucose_index)
+            scored["predicted_mgdl"] = denormalize_glucose(scored["predicted"].to_numpy(), pipeline.min_max_scaler, glucose_index)
+            table = pa.Table.from_pandas(scored, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(output, table.schema)
+            writer.write_table(table)
+            seconds = time.perf_counter() - model_start
+            stats.append({"model": os.path.splitext(os.path.basename(model_path))[0], "windows": len(scored),
+                          "seconds": seconds, "windows_per_second": len(scored) / seconds if seconds else 0.0})
+    finally:
+        if writer is not None:
+            writer.close()
+        if executor is not None:
+            executor.shutdown()
+    return pd.DataFrame(stats, columns=["model", "windows", "seconds", "windows_per_second"])
+
+
+def default_models(models_dir="models"):
+    """
+    :return: The LSTM models, these take windows of the resampled features
+    """
+    return sorted(os.path.join(models_dir, file) for file in os.listdir(models_dir)
+                  if file.endswith(".keras") and file.startswith("lstm_"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score every window of the history with the models")
+    parser.add_argument("--models", nargs="*", help="Model files, all LSTM models in models/ by default")
+    parser.add_argument("--output", default="backfill.parquet")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    stats = backfill(args.models or default_models(), args.output, workers=args.workers, chunk_size=args.chunk_size)
+    for row in stats.itertuples(index=False):
+        print(f"{row.model}: {row.windows} windows, {row.windows_per_second:.0f} windows/s")
+    windows, seconds = stats["windows"].sum(), stats["seconds"].sum()
+    print(f"Scored {windows} windows at {windows / seconds if seconds else 0:.0f} windows/s, written to {args.output}")
@@ -0,0 +1,227 @@
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from my_functions import interpolate_gaps, min_max_normalize
+from windowing import build_windows, HORIZONS
+from evaluation import evaluate_predictions, denormalize_glucose
+
+# Rolling-origin backtests: the model is refitted on every fold and scored on the period right after the fold's
+# training data, so the reported accuracy doesn't hinge on one test slice. Folds reuse the resampled feature frame
+# of the FeaturePipeline, every fold fits its own scaler on its training rows only and folds run in parallel:
+#   python backtest.py --models persistence linear lstm --horizon 2h --folds 5 --workers 5
+
+INPUT_WIDTH = 20
+DEFAULT_COLUMNS = ["Glucose", "Rapid Insulin IOB", "Carbohydrates"]
+# Same proportions as train_val_test_split, the last fold is exactly its fixed 70/20/10 split
+VAL_FRACTION = 0.2
+TEST_FRACTION = 0.1
+# Used by the lstm fold model when no hyperparameters are given
+LSTM_PARAMS = {"units": 32, "dropout": 0.05, "learning_rate": 0.01, "max_epochs": 60, "patience": 2,
+               "batch_size": 16}
+
+# Set in every worker process by _init_worker
+_frame = None
+
+
+def rolling_origin_folds(n, n_folds=5, val_fraction=VAL_FRACTION, test_fraction=TEST_FRACTION, expanding=True):
+    """
+    Splits n samples into folds of train, validation and test ranges, the test ranges are consecutive and the
+    last one ends with the data
+    :param n: Number of samples
+    :param n_folds: Number of folds
+    :param val_fraction: Validation share of the whole series
+    :param test_fraction: Test share of the whole series, every fold tests on this many samples
+    :param expanding: If true, every fold trains from the start of the series, otherwise the training range
+    rolls forward and keeps the length of the first fold's
+    :return: List of dictionaries with fold and the train, val and test (start, end) ranges
+    """
+    last_origin = int(n * (1 - test_fraction))
+    val_size = last_origin - int(n * (1 - test_fraction - val_fraction))
+    test_size = n - last_origin
+    first_origin = last_origin - (n_folds - 1) * test_size
+    if first_origin - val_size <= 0:
+        raise Exception(f"{n_folds} folds of {test_size} test samples leave no training data")
+
+    folds = []
+    train_size = first_origin - val_size
+    for fold in range(n_folds):
+        origin = first_origin + fold * test_size
+        train_end = origin - val_size
+        train_start = 0 if expanding else train_end - train_size
+        folds.append({
+            "fold": fold,
+            "train": (train_start, train_end),
+            "val": (train_end, origin),
+            "test": (origin, origin + test_size),
+        })
+    return folds
+
+
+def fold_frames(frame, fold, features):
+    """
+    Prepares a fold like FeaturePipeline.split and normalize do for the fixed split: gaps are interpolated in the
+    train and validation frames, test rows without glucose are dropped and the scaler is fitted on train only
+    :param frame: Resampled feature frame, e.g. FeaturePipeline().iob()
+    :param fold: Fold from rolling_origin_folds
+    :param features: Features to normalize
+    :return: Normalized train, validation and test frames and the fold's scaler
+    """
+    train_df, val_df, test_df = (frame[slice(*fold[split])].copy() for split in ["train", "val", "test"])
+    interpolate_gaps(train_df)
+    interpolate_gaps(val_df)
+    test_df = test_df.dropna(subset=["Glucose"])
+    min_max_scaler = min_max_normalize(train_df, val_df, test_df, features)
+    return train_df, val_df, test_df, min_max_scaler
+
+
+def fit_predict_persistence(train, val, test_inputs, params):
+    """
+    Baseline predicting the last glucose value of the window
+    """
+    return test_inputs[:, -1, 0]
+
+
+def fit_predict_linear(train, val, test_inputs, params):
+    """
+    Least squares on the flattened window, a fast baseline
+    """
+    train_inputs, train_labels = train
+    design = np.hstack([train_inputs.reshape(len(train_inputs), -1), np.ones((len(train_inputs), 1))])
+    coef, *_ = np.linalg.lstsq(design.astype(np.float64), train_labels.astype(np.float64), rcond=None)
+    return np.hstack([test_inputs.reshape(len(test_inputs), -1), np.ones((len(test_inputs), 1))]) @ coef
+
+
+def fit_predict_lstm(train, val, test_inputs, params):
+    """
+    Trains the notebook's LSTM model with fixed hyperparameters, early stopped on the fold's validation range
+    """
+    import tensorflow as tf
+    import keras_tuner as kt
+    from tuning import build_lstm_model
+
+    params = {**LSTM_PARAMS, **(params or {})}
+    hp = kt.HyperParameters()
+    hp.values.update({name: params[name] for name in ["units", "dropout", "learning_rate"]})
+    model = build_lstm_model(hp)
+    early_stopping = tf.keras.callbacks.EarlyStopping(monitor="val_loss", patience=params["patience"], mode="min")
+    model.fit(train[0], train[1].reshape(-1, 1), epochs=params["max_epochs"], batch_size=params["batch_size"],
+              validation_data=(val[0], val[1].reshape(-1, 1)), callbacks=[early_stopping], verbose=0)
+    return model.predict(test_inputs, batch_size=1024, verbose=0).reshape(-1)
+
+
+FOLD_MODELS = {
+    "persistence": fit_predict_persistence,
+    "linear": fit_predict_linear,
+    "lstm": fit_predict_lstm,
+}
+
+
+def _init_worker(frame, threads=None):
+    global _frame
+    _frame = frame
+    if threads:
+        # Folds run side by side, don't let every TensorFlow process take all the cores
+        os.environ["TF_NUM_INTRAOP_THREADS"] = str(threads)
+        os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+
+
+def _run_fold(job):
+    """
+    :param job: Tuple of fold, model name, columns, horizon, input width, scaler features and model params
+    :return: Dictionary of the fold's ranges and evaluation results
+    """
+    fold, model, columns, horizon, input_width, features, params = job
+    start = time.perf_counter()
+    train_df, val_df, test_df, scaler = fold_frames(_frame, fold, features)
+    label_column = columns.index("Glucose")
+
+    splits = {}
+    for split, split_df in [("train", train_df), ("val", val_df), ("test", test_df)]:
+        inputs, labels, mask = build_windows(split_df, input_width, HORIZONS[horizon], columns=columns,
+                                             label_column=label_column)
+        splits[split] = (np.ascontiguousarray(inputs[mask]), np.asarray(labels[mask]))
+
+    predictions = FOLD_MODELS[model](splits["train"], splits["val"], splits["test"][0], params)
+    glucose_index = features.index("Glucose")
+    results = evaluate_predictions(denormalize_glucose(splits["test"][1], scaler, glucose_index),
+                                   denormalize_glucose(np.asarray(predictions), scaler, glucose_index))
+    times = _frame["Time"]
+    return {
+        "model": model,
+        "fold": fold["fold"],
+        "train_start": times.iloc[fold["train"][0]],
+        "test_start": times.iloc[fold["test"][0]],
+        "test_end": times.iloc[fold["test"][1] - 1],
+        "train_windows": len(splits["train"][1]),
+        "test_windows": len(splits["test"][1]),
+        **results,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def backtest(models=("persistence", "linear"), columns=DEFAULT_COLUMNS, horizon="2h", n_folds=5, expanding=True,
+             workers=None, pipeline=None, params=None, input_width=INPUT_WIDTH):
+    """
+    :param models: Names of FOLD_MODELS to backtest
+    :param columns: Model input columns
+    :param horizon: Prediction horizon, see windowing.HORIZONS
+    :param n_folds: Number of folds, see rolling_origin_folds
+    :param expanding: Expanding (true) or rolling training ranges
+    :param workers: Number of processes, defaults to the number of cores
+    :param pipeline: FeaturePipeline providing the resampled features
+    :param params: Model parameters, e.g. the lstm hyperparameters
+    :return: DataFrame with one row of RMSE and CEGA results per model and fold
+    """
+    from my_functions import FeaturePipeline
+
+    unknown = [model for model in models if model not in FOLD_MODELS]
+    if unknown:
+        raise Exception(f"Models {unknown} not recognized, use any of {list(FOLD_MODELS)}")
+    pipeline = pipeline or FeaturePipeline()
+    frame = pipeline.iob()
+    features = [col for col in pipeline.using_features if col != "Time"]
+    folds = rolling_origin_folds(len(frame), n_folds, expanding=expanding)
+    jobs = [(fold, model, list(columns), horizon, input_width, features, params) for model in models for fold in folds]
+
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if workers > 1:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(frame, threads)) as executor:
+            rows = list(executor.map(_run_fold, jobs))
+    else:
+        _init_worker(frame)
+        rows = [_run_fold(job) for job in jobs]
+    return pd.DataFrame(rows)
+
+
+def summarize(results, metrics=("rmse", "mae", "zone_a", "zone_ab")):
+    """
+    :return: Mean and standard deviation of the metrics over the folds of every model
+    """
+    return results.groupby("model")[list(metrics)].agg(["mean", "std"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rolling-origin backtest of the glucose models")
+    parser.add_argument("--models", nargs="+", default=["persistence", "linear"], choices=list(FOLD_MODELS))
+    parser.add_argument("--columns", nargs="+", default=DEFAULT_COLUMNS)
+    parser.add_argument("--horizon", choices=list(HORIZONS), default="2h")
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--rolling", action="store_true", help="Roll the training range instead of expanding it")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default=None, help="CSV file for the per-fold results")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results = backtest(args.models, args.columns, args.horizon, args.folds, not args.rolling, args.workers)
+    columns = ["model", "fold", "test_start", "test_windows", "rmse", "mae", "zone_a", "zone_b", "zone_c", "zone_d",
+               "zone_e"]
+    print(results[columns].to_string(index=False))
+    print(summarize(results).to_string())
+    print(f"{len(results)} fold runs in {time.perf_counter() - start:.0f}s")
+    if args.output:
+        results.to_csv(args.output, index=False)
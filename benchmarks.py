@@ -0,0 +1,381 @@
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import fnmatch
+import platform
+import argparse
+import statistics
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+# The loaders cache into their own directories here, so cold runs can clear them without touching the real cache.
+# Set before the data modules are imported, they read it at import time.
+BENCHMARK_DIR = os.getenv("BENCHMARK_DIR", os.path.join(".cache", "benchmark"))
+os.environ["DATASET_CACHE_DIR"] = os.path.join(BENCHMARK_DIR, "datasets")
+os.environ["READER_STORE_DIR"] = os.path.join(BENCHMARK_DIR, "reader_store")
+
+import numpy as np
+
+# Benchmarks of the data, feature and inference hot paths. Results are written as JSON with the machine they ran
+# on and compared to the stored baseline, the run fails when a benchmark got slower than the threshold allows:
+#   python benchmarks.py                       # run everything and compare to benchmark_baseline.json
+#   python benchmarks.py --only "loader_*"     # a subset
+#   python benchmarks.py --save-baseline       # accept the current results as the new baseline
+
+BASELINE_PATH = "benchmark_baseline.json"
+# Allowed slowdown before a benchmark counts as regressed, 0.25 is 25% slower. The fastest run is compared, it's
+# the least affected by other load on the machine.
+REGRESSION_THRESHOLD = float(os.getenv("BENCHMARK_THRESHOLD", "0.25"))
+# Machine metadata which has to match the baseline's for timings to be comparable. Process pool benchmarks scale
+# with the cores, a baseline of another core count or processor says nothing about this machine.
+HOST_KEYS = ["processor", "cpu_count"]
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "src", "backend")
+
+GROUPS = {}
+
+
+def group(name):
+    """
+    Registers a benchmark group, a function yielding (benchmark name, function returning the result) pairs, so
+    benchmarks filtered out by name aren't run
+    """
+    def register(function):
+        GROUPS[name] = function
+        return function
+    return register
+
+
+def measure(function, repeat=5, warmup=1, number=1, setup=None):
+    """
+    :param function: Function without arguments to time
+    :param repeat: Number of timed runs
+    :param warmup: Untimed runs before them
+    :param number: Calls of function per run, the results are per call
+    :param setup: Untimed function called before every run, e.g. to clear a cache
+    :return: Dictionary with median, min, mean and max seconds per call
+    """
+    times = []
+    for i in range(warmup + repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = (time.perf_counter() - start) / number
+        if i >= warmup:
+            times.append(elapsed)
+    return {
+        "median": statistics.median(times),
+        "min": min(times),
+        "mean": statistics.fmean(times),
+        "max": max(times),
+        "repeat": repeat,
+        "number": number,
+    }
+
+
+def clear_dataset_caches():
+    for directory in [os.environ["DATASET_CACHE_DIR"], os.environ["READER_STORE_DIR"]]:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+@group("loaders")
+def loader_benchmarks(repeat):
+    import dataset
+
+    loaders = {
+        "reader": dataset.load_reader_dataset,
+        "mysugr": dataset.load_mySugr_dataset,
+        "fitbit": dataset.load_fitbit_dataset,
+        "fitbit_sleep": dataset.load_fitbit_sleep_dataset,
+        "fitbit_stress": dataset.load_fitbit_stress_dataset,
+        "fitbit_oxygen": dataset.load_fitbit_oxygen_dataset,
+    }
+    for name, load in loaders.items():
+        # Cold runs parse the raw exports, warm runs read the cached frame
+        yield f"loader_{name}_cold", lambda load=load: measure(load, repeat=max(1, repeat // 2), warmup=0,
+                                                               setup=clear_dataset_caches)
+        yield f"loader_{name}_warm", lambda load=load: measure(load, repeat=repeat)
+
+
+@group("features")
+def feature_benchmarks(repeat):
+    from my_functions import FeaturePipeline, resample_data
+    from insulin import insulin_on_board_series
+
+    pipeline = FeaturePipeline()
+    derived = pipeline.derive()
+    doses = pipeline.resample()["Rapid Insulin"].to_numpy()
+    yield "resample", lambda: measure(lambda: resample_data(derived, pipeline.sampl_freq), repeat=repeat)
+    yield "iob_series", lambda: measure(
+        lambda: insulin_on_board_series(doses, pipeline.sampl_freq, pipeline.insulin_profile), repeat=repeat, number=10)
+    # All stages after loading, with the loaders' cache warm
+    yield "pipeline_normalize", lambda: measure(lambda: FeaturePipeline().normalize(), repeat=max(1, repeat // 2))
+
+
+@group("windows")
+def window_benchmarks(repeat):
+    from my_functions import FeaturePipeline
+    from windowing import build_windows, HORIZONS
+
+    train_df = FeaturePipeline().normalize()[0]
+    columns = ["Glucose", "Rapid Insulin IOB", "Carbohydrates"]
+
+    def build():
+        inputs, labels, mask = build_windows(train_df, 20, HORIZONS["2h"], columns=columns)
+        return np.ascontiguousarray(inputs[mask])
+
+    yield "build_windows", lambda: measure(build, repeat=repeat, number=10)
+
+
+def backend_package():
+    """
+    Makes the backend modules importable without app/__init__.py, which connects to Firebase
+    """
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, BACKEND_DIR)
+    if "app" not in sys.modules:
+        package = types.ModuleType("app")
+        package.__path__ = [os.path.join(BACKEND_DIR, "app")]
+        sys.modules["app"] = package
+
+
+@group("predictor")
+def predictor_benchmarks(repeat):
+    backend_package()
+    from app.predictive_analytics import GlucosePredictor
+
+    predictor = GlucosePredictor(batching=False, cache=False)
+    window = predictor.examples[0]
+    predictor.predict_next_2h(window)
+    yield "predictor_single", lambda: measure(lambda: predictor.predict_next_2h(window), repeat=repeat, number=100)
+    yield "predictor_horizons", lambda: measure(lambda: predictor.predict_horizons(window), repeat=repeat, number=100)
+
+    # Concurrent requests collected into batches by the micro-batcher, timed per round of callers
+    batched = GlucosePredictor(batching=True, cache=False)
+    callers = 32
+    windows = predictor.examples[:callers]
+
+    def concurrent_round():
+        threads = [threading.Thread(target=batched.predict_next_2h, args=(window,)) for window in windows]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    yield f"predictor_batched_{callers}", lambda: measure(concurrent_round, repeat=repeat, number=10)
+    batched.batcher.close()
+
+
+class _StubTask:
+    id = "benchmark"
+
+    def __init__(self, result):
+        self.result = result
+
+    def get(self):
+        return self.result
+
+
+def install_service_stubs():
+    """
+    Replaces Firebase, the Celery tasks and transcription with local stubs, so the endpoints run without
+    credentials or network
+    """
+    backend_package()
+    firebase_admin = types.ModuleType("firebase_admin")
+    for name in ["credentials", "storage", "firestore"]:
+        setattr(firebase_admin, name, types.SimpleNamespace())
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+    sys.modules["firebase_admin"] = firebase_admin
+
+    firebase_client = types.ModuleType("app.firebase_client")
+    firebase_client.db = None
+    firebase_client.bucket = None
+    firebase_client.send_notification = lambda *args, **kwargs: None
+    sys.modules["app.firebase_client"] = firebase_client
+
+    tasks = types.ModuleType("app.tasks")
+    tasks.generate_tts_notification = types.SimpleNamespace(delay=lambda *args: _StubTask(b""))
+    tasks.send_glucose_notification = types.SimpleNamespace(delay=lambda *args: _StubTask([b"audio"] * 4))
+    sys.modules["app.tasks"] = tasks
+
+    transcription = types.ModuleType("app.transcription")
+    transcription.transcription = lambda *args, **kwargs: ""
+    transcription.action_items = lambda *args, **kwargs: []
+    sys.modules["app.transcription"] = transcription
+
+
+@group("endpoints")
+def endpoint_benchmarks(repeat):
+    install_service_stubs()
+    from flask import Flask
+    from app.routes import main_blueprint
+    from app.prediction_cache import get_prediction_cache
+
+    app = Flask(__name__)
+    app.register_blueprint(main_blueprint)
+    client = app.test_client()
+    window = np.random.default_rng(0).random((20, 3)).tolist()
+
+    def post(path, payload):
+        response = client.post(path, json=payload)
+        response.get_data()
+        if response.status_code != 200:
+            raise Exception(f"{path} returned {response.status_code}")
+
+    def post_uncached(path, payload):
+        # The cache is cleared after every request so each one predicts, the cached path is timed on its own
+        post(path, payload)
+        get_prediction_cache().clear()
+
+    post_uncached("/predict_glucose", {"readings": [5.5]})
+    yield "endpoint_predict_glucose", lambda: measure(
+        lambda: post_uncached("/predict_glucose", {"readings": [5.5]}), repeat=repeat, number=50)
+    yield "endpoint_predict_glucose_notification", lambda: measure(
+        lambda: post_uncached("/predict_glucose", {"readings": [5.5], "firebase_token": "benchmark"}),
+        repeat=repeat, number=50)
+    yield "endpoint_trajectory_cached", lambda: measure(
+        lambda: post("/predict_glucose/trajectory", {"window": window}), repeat=repeat, number=50)
+    yield "endpoint_cache_stats", lambda: measure(
+        lambda: client.get("/predict_glucose/cache").get_data(), repeat=repeat, number=100)
+
+
+def machine_metadata():
+    try:
+        import pandas as pd
+        pandas_version = pd.__version__
+    except ImportError:
+        pandas_version = None
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pandas_version,
+    }
+
+
+def _run_group(name, repeat, only):
+    """
+    :return: Tuple of the group's results by benchmark name and the reason it was skipped, or None
+    """
+    results = {}
+    try:
+        for benchmark, function in GROUPS[name](repeat):
+            if only is None or fnmatch.fnmatch(benchmark, only):
+                results[benchmark] = function()
+                print(f"{benchmark}: {results[benchmark]['median'] * 1e3:.3f} ms", flush=True)
+    except ImportError as e:
+        print(f"{name}: skipped, {e}", flush=True)
+        return results, str(e)
+    return results, None
+
+
+def run(groups=None, only=None, repeat=5):
+    """
+    :param groups: Names of GROUPS to run, all by default
+    :param only: Glob pattern of benchmark names to keep
+    :param repeat: Timed runs of every benchmark
+    :return: Dictionary with the machine metadata and the results by benchmark name, a group which can't run
+    here (e.g. without Flask) is recorded as skipped
+    """
+    results, skipped = {}, {}
+    # Every group runs in a fresh process, so its timings don't depend on what ran before it (loaded frames,
+    # imported modules, warmed up models)
+    context = multiprocessing.get_context("spawn")
+    for name in groups or GROUPS:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            group_results, reason = executor.submit(_run_group, name, repeat, only).result()
+        results.update(group_results)
+        if reason is not None:
+            skipped[name] = reason
+    return {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "machine": machine_metadata(),
+        "threshold": REGRESSION_THRESHOLD,
+        "results": results,
+        "skipped": skipped,
+    }
+
+
+def host_differences(current, baseline, keys=HOST_KEYS):
+    """
+    :return: Dictionary of the machine metadata keys whose values differ, with the (baseline, current) values
+    """
+    return {key: (baseline["machine"].get(key), current["machine"].get(key)) for key in keys
+            if baseline["machine"].get(key) != current["machine"].get(key)}
+
+
+def compare(current, baseline, threshold=REGRESSION_THRESHOLD, other_host=False):
+    """
+    :param other_host: Compare against a baseline recorded on another host (see HOST_KEYS), which is refused
+    otherwise
+    :return: List of (benchmark, baseline time, current time, ratio) of the benchmarks which got slower by more
+    than the threshold
+    """
+    differences = host_differences(current, baseline)
+    if differences and not other_host:
+        raise Exception("Baseline was recorded on another host (" + ", ".join(
+            f"{key} {old} here {new}" for key, (old, new) in differences.items()) + "), record one on this "
+            "host with --save-baseline")
+    regressions = []
+    for name, result in current["results"].items():
+        reference = baseline["results"].get(name)
+        if reference is None or not reference["min"]:
+            continue
+        ratio = result["min"] / reference["min"]
+        if ratio > 1 + threshold:
+            regressions.append((name, reference["min"], result["min"], ratio))
+    return regressions
+
+
+def write_json(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the data, feature and inference hot paths")
+    parser.add_argument("--groups", nargs="+", choices=list(GROUPS), default=None)
+    parser.add_argument("--only", default=None, help="Glob pattern of benchmark names, e.g. 'loader_*'")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=os.path.join(BENCHMARK_DIR, "results.json"))
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--other-host", action="store_true",
+                        help="Compare even if the baseline was recorded with another processor or core count")
+    args = parser.parse_args()
+
+    current = run(args.groups, args.only, args.repeat)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    write_json(current, args.output)
+    if args.save_baseline:
+        write_json(current, args.baseline)
+        print(f"Baseline written to {args.baseline}")
+        sys.exit(0)
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one")
+        sys.exit(0)
+
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    if baseline["machine"] != current["machine"]:
+        print(f"Baseline was recorded on {baseline['machine']}, timings may not be comparable")
+    try:
+        regressions = compare(current, baseline, args.threshold, other_host=args.other_host)
+    except Exception as e:
+        print(f"{e}, or pass --other-host")
+        sys.exit(2)
+    for name, reference, result, ratio in regressions:
+        print(f"REGRESSION {name}: {reference * 1e3:.3f} ms -> {result * 1e3:.3f} ms ({ratio:.2f}x)")
+    if regressions:
+        sys.exit(1)
+    print(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
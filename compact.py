@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+
+# The merged frame is mostly NaN, the three sources are concatenated and every row carries only the
+# columns of its own source. Storing measures as float32, text as categories and mostly-empty columns as
+# sparse arrays keeps many patients' histories resident in one process.
+
+# Columns with a larger share of missing values are stored sparse
+SPARSE_THRESHOLD = 0.5
+
+
+def compact_frame(df, sparse_threshold=SPARSE_THRESHOLD):
+    """
+    :param df: Frame to compact, it is not modified
+    :param sparse_threshold: Share of missing values above which a column is stored sparse
+    :return: Frame with float32 measures, categorical text and sparse mostly-empty columns
+    """
+    columns = {}
+    for col in df.columns:
+        values = df[col]
+        if pd.api.types.is_float_dtype(values.dtype) or pd.api.types.is_integer_dtype(values.dtype):
+            values = values.astype(np.float32)
+            if values.isna().mean() > sparse_threshold:
+                values = values.astype(pd.SparseDtype(np.float32, np.nan))
+        elif values.dtype == object:
+            values = values.astype("category")
+        columns[col] = values
+    return pd.DataFrame(columns, index=df.index)
+
+
+def expand_frame(df):
+    """
+    Converts a compacted frame back to dense float64 and object columns, so it can go through the rest of
+    the pipeline. Values keep the float32 precision they were stored with.
+    """
+    columns = {}
+    for col in df.columns:
+        values = df[col]
+        if isinstance(values.dtype, pd.SparseDtype):
+            values = values.sparse.to_dense()
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype(object).where(values.notna(), np.nan)
+        elif values.dtype == np.float32:
+            values = values.astype(np.float64)
+        columns[col] = values
+    return pd.DataFrame(columns, index=df.index)
+
+
+def frame_memory(obj):
+    """
+    :param obj: DataFrame or a (nested) tuple, list or dict of DataFrames
+    :return: Bytes held by the frames, including object contents
+    """
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, dict):
+        return sum(frame_memory(value) for value in obj.values())
+    if isinstance(obj, (tuple, list)):
+        return sum(frame_memory(value) for value in obj)
+    return 0
+
+
+def frame_rows(obj):
+    if isinstance(obj, pd.DataFrame):
+        return len(obj)
+    if isinstance(obj, dict):
+        return sum(frame_rows(value) for value in obj.values())
+    if isinstance(obj, (tuple, list)):
+        return sum(frame_rows(value) for value in obj)
+    return 0
@@ -0,0 +1,101 @@
+import os
+import json
+import hashlib
+import pandas as pd
+
+# Where normalized loader outputs are stored, can be overridden per machine
+CACHE_DIR = os.getenv("DATASET_CACHE_DIR", ".cache/datasets")
+
+try:
+    import pyarrow  # noqa: F401
+    CACHE_FORMAT = "parquet"
+except ImportError:
+    # Fall back to pickle, still binary and much faster than re-parsing the raw exports
+    CACHE_FORMAT = "pickle"
+
+
+def source_fingerprint(sources, version, hash_contents=False):
+    """
+    Builds a key which changes whenever any of the source files or the loader itself changes
+    :param sources: List of source file paths the loader reads
+    :param version: Version of the loader, bump it whenever the normalization logic changes
+    :param hash_contents: If true, hash file contents instead of relying on size and mtime
+    :return: Hex digest identifying the loader output
+    """
+    h = hashlib.sha256()
+    h.update(str(version).encode())
+    for source in sorted(sources):
+        st = os.stat(source)
+        h.update(source.encode())
+        if hash_contents:
+            with open(source, "rb") as f:
+                h.update(hashlib.sha256(f.read()).digest())
+        else:
+            h.update(f"{st.st_size}:{st.st_mtime_ns}".encode())
+    return h.hexdigest()[:16]
+
+
+def write_frame(df, path):
+    if CACHE_FORMAT == "parquet":
+        df.to_parquet(path)
+    else:
+        df.to_pickle(path)
+
+
+def read_frame(path):
+    if CACHE_FORMAT == "parquet":
+        return pd.read_parquet(path)
+    return pd.read_pickle(path)
+
+
+def cache_path(name, key):
+    extension = "parquet" if CACHE_FORMAT == "parquet" else "pkl"
+    return os.path.join(CACHE_DIR, f"{name}-{key}.{extension}")
+
+
+def cached_frame(name, version, sources, build, use_cache=True, hash_contents=False):
+    """
+    Returns the output of a loader, rebuilding it only when its inputs changed
+    :param name: Name of the cached dataset, e.g. "reader"
+    :param version: Loader version, part of the cache key
+    :param sources: Source files the loader depends on
+    :param build: Function without arguments producing the normalized DataFrame
+    :param use_cache: If false, always rebuild and do not touch the cache
+    :param hash_contents: Key on file contents instead of size and mtime
+    :return: Normalized DataFrame
+    """
+    if not use_cache:
+        return build()
+
+    key = source_fingerprint(sources, version, hash_contents)
+    path = cache_path(name, key)
+    if os.path.exists(path):
+        return read_frame(path)
+
+    df = build()
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Drop outdated entries of this dataset, only the latest one is ever read
+    for entry in os.listdir(CACHE_DIR):
+        if entry.startswith(f"{name}-"):
+            os.remove(os.path.join(CACHE_DIR, entry))
+
+    # Write to a temporary file first so a crashed run never leaves a truncated entry behind
+    tmp_path = path + ".tmp"
+    write_frame(df, tmp_path)
+    os.replace(tmp_path, path)
+    with open(os.path.join(CACHE_DIR, f"{name}-{key}.json"), "w") as f:
+        json.dump({"name": name, "version": version, "sources": sorted(sources)}, f, indent=2)
+    return df
+
+
+def clear_cache(name=None):
+    """
+    Removes cached datasets
+    :param name: Only remove entries of this dataset, all entries if None
+    """
+    if not os.path.isdir(CACHE_DIR):
+        return
+    for entry in os.listdir(CACHE_DIR):
+        if name is None or entry.startswith(f"{name}-"):
+            os.remove(os.path.join(CACHE_DIR, entry))
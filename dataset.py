@@ -2,18 +2,48 @@ import os
 import pandas as pd
 import numpy as np
 import json
+from concurrent.futures import ProcessPoolExecutor
+from data_cache import cached_frame
+from reader_store import sync_store, read_store, read_exports
+from features import combine_rapid_insulin
 
-def load_reader_dataset():
+# Bump a loader version whenever its normalization changes, so cached outputs get rebuilt
+READER_LOADER_VERSION = 2
+MYSUGR_LOADER_VERSION = 1
+FITBIT_LOADER_VERSION = 1
+FITBIT_SLEEP_LOADER_VERSION = 1
+FITBIT_STRESS_LOADER_VERSION = 1
+FITBIT_OXYGEN_LOADER_VERSION = 1
+
+FITBIT_EXPORT_DIR = "data/fitbit_data/2022_04_25_all_time_export"
+
+
+def reader_exports():
     reader_data = "data/reader_data"
     exports = [os.path.join(reader_data, export) for export in os.listdir(reader_data)]
     exports.sort(reverse=False)
+    return exports
 
-    df = pd.read_csv(exports[0], sep="\t")
-    for export in exports[1:]:
-        df = pd.concat([df, pd.read_csv(export, sep="\t")])
 
-    # Exports usually overlap, so drop the duplicates
-    df.drop_duplicates(inplace=True)
+def load_reader_dataset(use_cache=True, incremental=True):
+    """
+    Loads LibreView glucose, insulin and carbohydrate records
+    :param use_cache: Reuse the cached output while the exports don't change
+    :param incremental: Merge new exports into the persisted reader store instead of re-reading all of them
+    """
+    exports = reader_exports()
+    return cached_frame("reader", READER_LOADER_VERSION, exports,
+                        lambda: parse_reader_dataset(exports, incremental), use_cache)
+
+
+def parse_reader_dataset(exports, incremental=True):
+    if incremental:
+        # Exports usually overlap, the store keeps every row only once
+        sync_store(exports)
+        df = read_store()
+    else:
+        # Exports usually overlap, so drop the duplicates. Same rows and order as the store.
+        df = read_exports(exports)
 
     # Dropping column which aren't used
     df.drop(['Non-numeric Food', 'Non-numeric Long-Acting Insulin', 'Non-numeric Rapid-Acting Insulin',
@@ -37,17 +67,19 @@ def load_reader_dataset():
     return df
 
 
-def load_mySugr_dataset():
+def load_mySugr_dataset(use_cache=True):
     mySugr_data = "data/mySugr_data/2022_01_09-2022_04_25_export.csv"
+    return cached_frame("mysugr", MYSUGR_LOADER_VERSION, [mySugr_data], lambda: parse_mySugr_dataset(mySugr_data), use_cache)
+
+
+def parse_mySugr_dataset(mySugr_data):
     mysugr_df = pd.read_csv(mySugr_data, sep=",")
 
     # Keeping only the relevant columns
     mysugr_df = mysugr_df[['Date', 'Time', 'Tags', 'Basal Injection Units', 'Insulin (Meal)', 'Insulin (Correction)',
                            'Meal Carbohydrates (Grams, Factor 1)', 'Meal Descriptions', 'Body weight (kg)', 'Food type']]
 
-    mysugr_df["Rapid Insulin"] = mysugr_df[["Insulin (Meal)", "Insulin (Correction)"]].apply(
-        lambda x: x["Insulin (Correction)"] if np.isnan(x["Insulin (Meal)"]) else x["Insulin (Meal)"], axis=1
-    )
+    mysugr_df["Rapid Insulin"] = combine_rapid_insulin(mysugr_df["Insulin (Meal)"], mysugr_df["Insulin (Correction)"])
 
     mysugr_df.rename(columns={'Basal Injection Units': 'Long Insulin',
                               'Meal Carbohydrates (Grams, Factor 1)': 'Carbohydrates',
@@ -62,53 +94,227 @@ def load_mySugr_dataset():
 def read_fitbit_json_export(export_file, export_type):
     with open(export_file, "r") as f:
         j = json.load(f)
-    df_read = pd.json_normalize(j)
-    df_read["dateTime"] = pd.to_datetime(df_read["dateTime"], format="%m/%d/%y %H:%M:%S")
 
+    # Build typed columns straight from the records, json_normalize is far too slow for per-second data
+    date_times = pd.to_datetime([record["dateTime"] for record in j], format="%m/%d/%y %H:%M:%S")
     if export_type == "heart":
-        df_read.rename(columns={"value.bpm": "bpm"}, inplace=True)
-        df_read.drop("value.confidence", axis=1, inplace=True)
+        values = np.array([record["value"]["bpm"] for record in j], dtype=np.int64)
+        column = "bpm"
     elif export_type == "calories":
-        df_read.rename(columns={"value": "calories"}, inplace=True)
-        df_read["calories"] = df_read["calories"].astype(float)
+        values = np.array([record["value"] for record in j], dtype=float)
+        column = "calories"
     elif export_type == "distance":
-        df_read.rename(columns={"value": "distance"}, inplace=True)
-        df_read["distance"] = df_read["distance"].astype(int)
         # Convert from centimeters to meters
-        df_read["distance"] = df_read["distance"] / 100
+        values = np.array([record["value"] for record in j]).astype(int) / 100
+        column = "distance"
     else:
         raise Exception("Export type not recognized")
-    return df_read
+    return pd.DataFrame({"dateTime": date_times, column: values})
+
+
+def _read_fitbit_job(job):
+    return read_fitbit_json_export(*job)
+
 
+def aggregate_fitbit_export(job):
+    """
+    Reads a single export and reduces it to partial 1-minute aggregates, so only one raw file is held in memory
+    :param job: Tuple of export file and export type
+    :return: DataFrame indexed by minute with <column>_sum (and bpm_count for heart rate) partials
+    """
+    df_read = read_fitbit_json_export(*job)
+    column = df_read.columns[1]
+    grouped = df_read[column].groupby(df_read["dateTime"].dt.floor("1T").values)
+    partial = pd.DataFrame({f"{column}_sum": grouped.sum()})
+    if column == "bpm":
+        partial["bpm_count"] = grouped.count()
+    return partial
 
-def load_fitbit_dataset():
-    fitbit_data = "data/fitbit_data/2022_04_25_all_time_export/Physical Activity/"
+
+def merge_fitbit_partials(partials):
+    """
+    Combines per-file partial aggregates into the same frame the 1-minute resample produces. Minutes split
+    between two exports are summed up first, so the mean heart rate is computed over all of their samples.
+    """
+    columns = ["bpm_sum", "bpm_count", "distance_sum", "calories_sum"]
+    merged = pd.concat(partials).groupby(level=0).sum().reindex(columns=columns, fill_value=0)
+    # Resampling also creates the empty minutes between the first and the last sample
+    full_range = pd.date_range(merged.index.min(), merged.index.max(), freq="1T", name="Time")
+    merged = merged.reindex(full_range, fill_value=0)
+
+    df_fitbit = pd.DataFrame({
+        # Minutes without any heart rate sample end up as 0 / 0 = NaN, same as mean of an empty bin
+        "bpm": merged["bpm_sum"].astype(float) / merged["bpm_count"],
+        "distance": merged["distance_sum"].astype(float),
+        "calories": merged["calories_sum"].astype(float),
+    }).reset_index()
+    return df_fitbit
+
+
+def fitbit_exports():
+    fitbit_data = os.path.join(FITBIT_EXPORT_DIR, "Physical Activity")
     calories_exports = sorted([os.path.join(fitbit_data, export) for export in os.listdir(fitbit_data) if "calories" in export])
 
     distance_exports = sorted([os.path.join(fitbit_data, export) for export in os.listdir(fitbit_data) if "distance" in export])
 
     heart_rate_exports = sorted([os.path.join(fitbit_data, export) for export in os.listdir(fitbit_data)
                                  if "heart_rate-" in export and not "resting" in export])
+    return calories_exports, distance_exports, heart_rate_exports
+
+
+def map_exports(function, jobs, workers=None):
+    """
+    Applies function to every job, spreading the jobs over a process pool
+    :param function: Picklable (module level) function taking a single job
+    :param jobs: List of jobs, results are returned in the same order
+    :param workers: Number of worker processes, defaults to the number of cores
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(jobs) <= 1:
+        return [function(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+
+
+def load_fitbit_dataset(use_cache=True, workers=None, streaming=True):
+    """
+    Loads calories, distance and heart rate at 1 minute frequency
+    :param use_cache: Reuse the cached output while the exports don't change
+    :param workers: Number of processes parsing the exports
+    :param streaming: Reduce every export to 1-minute bins while reading it, instead of holding all raw samples
+    """
+    calories_exports, distance_exports, heart_rate_exports = fitbit_exports()
+    return cached_frame("fitbit", FITBIT_LOADER_VERSION, calories_exports + distance_exports + heart_rate_exports,
+                        lambda: parse_fitbit_dataset(calories_exports, distance_exports, heart_rate_exports,
+                                                     workers, streaming),
+                        use_cache)
+
+
+def parse_fitbit_dataset(calories_exports, distance_exports, heart_rate_exports, workers=None, streaming=True):
+    jobs = [(export, "calories") for export in calories_exports] + \
+           [(export, "distance") for export in distance_exports] + \
+           [(export, "heart") for export in heart_rate_exports]
+    if streaming:
+        return merge_fitbit_partials(map_exports(aggregate_fitbit_export, jobs, workers))
 
-    df_fitbit = read_fitbit_json_export(calories_exports[0], "calories")
-    for export in calories_exports[1:]:
-        df_fitbit = pd.concat([df_fitbit, read_fitbit_json_export(export, "calories")], ignore_index=True)
-    for export in distance_exports:
-        df_fitbit = pd.concat([df_fitbit, read_fitbit_json_export(export, "distance")], ignore_index=True)
-    for export in heart_rate_exports:
-        df_fitbit = pd.concat([df_fitbit, read_fitbit_json_export(export, "heart")], ignore_index=True)
+    # Parse the exports concurrently and concatenate only once, keeps ingestion linear in the number of files
+    df_fitbit = pd.concat(map_exports(_read_fitbit_job, jobs, workers), ignore_index=True)
 
     # Change to 1 minute frequency, to lower amount of rows
+    # Named aggregations run in cython, the pd.Series.* callables are applied group by group
     df_fitbit = df_fitbit.set_index('dateTime').resample('1T').agg(
         {
-            'bpm': pd.Series.mean,
-            'distance': pd.Series.sum,
-            'calories': pd.Series.sum
+            'bpm': 'mean',
+            'distance': 'sum',
+            'calories': 'sum'
         }
     ).reset_index()
 
     df_fitbit.rename(columns={"dateTime": "Time"}, inplace=True)
     df_fitbit.sort_values(by='Time', inplace=True)
     return df_fitbit
-import os
-import pandas as pd
+
+
+def fitbit_csv_exports(directory, prefix):
+    """
+    :param directory: Directory of the Fitbit export, e.g. "Sleep"
+    :param prefix: Start of the file names, e.g. "Computed Temperature"
+    :return: Sorted list of the matching csv exports
+    """
+    fitbit_data = os.path.join(FITBIT_EXPORT_DIR, directory)
+    return sorted([os.path.join(fitbit_data, export) for export in os.listdir(fitbit_data)
+                   if export.startswith(prefix) and export.endswith(".csv")])
+
+
+def read_fitbit_csv_export(job):
+    """
+    Reads a single csv export, keeping only the timestamp and the renamed value columns
+    :param job: Tuple of export file, timestamp column, timestamp format and {export column: feature column}
+    :return: DataFrame with Time and the feature columns
+    """
+    export_file, time_column, time_format, columns = job
+    df_read = pd.read_csv(export_file, usecols=[time_column] + list(columns))
+    df_read["Time"] = pd.to_datetime(df_read[time_column], format=time_format)
+    df_read.rename(columns=columns, inplace=True)
+    return df_read[["Time"] + list(columns.values())]
+
+
+def read_fitbit_csv_exports(jobs, workers=None):
+    frames = [frame for frame in map_exports(read_fitbit_csv_export, jobs, workers) if len(frame)]
+    df = pd.concat(frames, ignore_index=True)
+    df.sort_values(by='Time', inplace=True, kind="stable")
+    return df.reset_index(drop=True)
+
+
+def fitbit_sleep_exports():
+    temperature_exports = fitbit_csv_exports("Sleep", "Computed Temperature")
+    hrv_exports = fitbit_csv_exports("Sleep", "Daily Heart Rate Variability Summary")
+    respiratory_exports = fitbit_csv_exports("Sleep", "Daily Respiratory Rate Summary")
+    return temperature_exports, hrv_exports, respiratory_exports
+
+
+def load_fitbit_sleep_dataset(use_cache=True, workers=None):
+    """
+    Loads the nightly skin temperature and the daily heart rate variability and respiratory rate summaries,
+    one row per night and summary
+    :param use_cache: Reuse the cached output while the exports don't change
+    :param workers: Number of processes parsing the exports
+    """
+    temperature_exports, hrv_exports, respiratory_exports = fitbit_sleep_exports()
+    return cached_frame("fitbit_sleep", FITBIT_SLEEP_LOADER_VERSION,
+                        temperature_exports + hrv_exports + respiratory_exports,
+                        lambda: parse_fitbit_sleep_dataset(temperature_exports, hrv_exports, respiratory_exports,
+                                                           workers),
+                        use_cache)
+
+
+def parse_fitbit_sleep_dataset(temperature_exports, hrv_exports, respiratory_exports, workers=None):
+    # Temperature is only known once the sleep ends, the daily summaries are stamped with their date
+    jobs = [(export, "sleep_end", "ISO8601", {"nightly_temperature": "temperature"}) for export in temperature_exports] + \
+           [(export, "timestamp", "ISO8601", {"rmssd": "hrv", "nremhr": "nrem bpm", "entropy": "hrv entropy"})
+            for export in hrv_exports] + \
+           [(export, "timestamp", "ISO8601", {"daily_respiratory_rate": "respiratory rate"})
+            for export in respiratory_exports]
+    return read_fitbit_csv_exports(jobs, workers)
+
+
+def load_fitbit_stress_dataset(use_cache=True):
+    """
+    Loads the daily stress score, days the score couldn't be calculated for are left out
+    """
+    stress_export = os.path.join(FITBIT_EXPORT_DIR, "Stress", "Stress Score.csv")
+    return cached_frame("fitbit_stress", FITBIT_STRESS_LOADER_VERSION, [stress_export],
+                        lambda: parse_fitbit_stress_dataset(stress_export),
+                        use_cache)
+
+
+def parse_fitbit_stress_dataset(stress_export):
+    stress_df = pd.read_csv(stress_export)
+    stress_df = stress_df[(stress_df["STATUS"] == "READY") & ~stress_df["CALCULATION_FAILED"]]
+    stress_df = pd.DataFrame({
+        "Time": pd.to_datetime(stress_df["DATE"], format="ISO8601"),
+        "stress score": stress_df["STRESS_SCORE"].astype(float),
+    })
+    stress_df.sort_values(by='Time', inplace=True)
+    return stress_df.reset_index(drop=True)
+
+
+def load_fitbit_oxygen_dataset(use_cache=True, workers=None):
+    """
+    Loads the estimated oxygen variation (infrared to red signal ratio) at 1 minute frequency
+    :param use_cache: Reuse the cached output while the exports don't change
+    :param workers: Number of processes parsing the exports
+    """
+    oxygen_exports = fitbit_csv_exports("Other", "estimated_oxygen_variation")
+    return cached_frame("fitbit_oxygen", FITBIT_OXYGEN_LOADER_VERSION, oxygen_exports,
+                        lambda: parse_fitbit_oxygen_dataset(oxygen_exports, workers),
+                        use_cache)
+
+
+def parse_fitbit_oxygen_dataset(oxygen_exports, workers=None):
+    jobs = [(export, "timestamp", "%m/%d/%y %H:%M:%S", {"Infrared to Red Signal Ratio": "oxygen variation"})
+            for export in oxygen_exports]
+    oxygen_df = read_fitbit_csv_exports(jobs, workers)
+    # Samples are taken once a minute at an arbitrary second, align them with the other 1 minute data
+    oxygen_df["oxygen variation"] = oxygen_df["oxygen variation"].astype(float)
+    return oxygen_df.groupby(oxygen_df["Time"].dt.floor("1T"))["oxygen variation"].mean().reset_index()
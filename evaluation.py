@@ -0,0 +1,277 @@
+import numpy as np
+
+# Model evaluation without TensorFlow: RMSE, MAE, time in range and Clarke Error Grid Analysis (CEGA), ported
+# from prediction_models.ipynb. Everything works on whole arrays, determine_zone is kept as the reference for
+# zone_array. Values are blood glucose in mg/dl unless stated otherwise.
+
+ZONES = ["A", "B", "C", "D", "E"]
+
+
+def determine_zone(actual, pred):
+    """
+    Determines CEGA zone for given scatter point
+    :param actual: Reference value
+    :param pred: Predicted value
+    :return: CEGA zone where the given scatter point should lay
+    """
+    #Zone A
+    if (actual <= 70 and pred <= 70) or 1.2 * actual >= pred >= 0.8 * actual:
+        return 0
+
+    # Zone E - left upper
+    if actual <= 70 and pred >= 180:
+        return 4
+    # Zone E - right lower
+    if actual >= 180 and pred <= 70:
+        return 4
+
+    # Zone C - upper
+    if 70 <= actual <= 290 and pred >= actual + 110:
+        return 2
+    # Zone C - lower
+    if 130 <= actual <= 180 and pred <= (7/5) * actual - 182:
+        return 2
+
+    # Zone D - right
+    if actual >= 240 and 70 <= pred <= 180:
+        return 3
+    # Zone D - left
+    if actual <= 70 <= pred <= 180:
+        return 3
+
+    #Zone B
+    else:
+        return 1
+
+
+def zone_array(actual, pred):
+    """
+    determine_zone for whole arrays, the conditions are checked with boolean masks in the same order. Values are
+    compared in float64, the same as determine_zone does for Python or float64 values.
+    :param actual: Array of reference values
+    :param pred: Array of predicted values, broadcast against actual (e.g. (models, N) against (N,))
+    :return: int8 array of zones 0-4 (A-E)
+    """
+    actual = np.asarray(actual, dtype=np.float64)
+    pred = np.asarray(pred, dtype=np.float64)
+    zone_a = ((actual <= 70) & (pred <= 70)) | ((1.2 * actual >= pred) & (pred >= 0.8 * actual))
+    zone_e = ((actual <= 70) & (pred >= 180)) | ((actual >= 180) & (pred <= 70))
+    zone_c = ((70 <= actual) & (actual <= 290) & (pred >= actual + 110)) | \
+             ((130 <= actual) & (actual <= 180) & (pred <= (7/5) * actual - 182))
+    zone_d = ((actual >= 240) & (70 <= pred) & (pred <= 180)) | ((actual <= 70) & (70 <= pred) & (pred <= 180))
+    # np.select takes the first matching condition, like the early returns of determine_zone
+    return np.select([zone_a, zone_e, zone_c, zone_d], [0, 4, 2, 3], default=1).astype(np.int8)
+
+
+def zone_shares(zones, axis=-1):
+    """
+    :param zones: Array of zones from zone_array
+    :return: Share of zones A-E along axis, e.g. (models, 5) for zones of shape (models, N)
+    """
+    zones = np.asarray(zones)
+    if zones.shape[axis] == 0:
+        return np.zeros(zones.shape[:axis % zones.ndim] + (5,))
+    return np.stack([(zones == zone).mean(axis=axis) for zone in range(5)], axis=-1)
+
+
+def clarke_zones(ref_values, pred_values):
+    """
+    :return: Share of the points in each of the zones A-E
+    """
+    if not len(ref_values) or not len(pred_values):
+        return [0] * 5
+    return [float(share) for share in zone_shares(zone_array(ref_values, pred_values))]
+
+
+def check_zone_array(ref_values, pred_values):
+    """
+    Asserts zone_array assigns every point the same zone as determine_zone
+    """
+    ref_values = np.ravel(np.asarray(ref_values, dtype=np.float64))
+    pred_values = np.ravel(np.asarray(pred_values, dtype=np.float64))
+    expected = np.array([determine_zone(float(actual), float(pred)) for actual, pred in zip(ref_values, pred_values)])
+    mismatches = np.flatnonzero(zone_array(ref_values, pred_values) != expected)
+    if len(mismatches):
+        first = mismatches[0]
+        raise Exception(f"{len(mismatches)} zones differ, e.g. actual {ref_values[first]} predicted {pred_values[first]}")
+
+
+def clarke_error_grid(ref_values, pred_values):
+    """
+    Calculates the Clarke error grid zone statistics, plotting stays in the notebook
+    :param ref_values: Array of reference BG values
+    :param pred_values: Array of predicted BG values
+    :return: Percentage of points within CEGA zones
+    """
+    if len(ref_values) != len(pred_values):
+        raise Exception(f"Got {len(ref_values)} reference values and {len(pred_values)} predicted values, values must match.")
+
+    if len(ref_values) and len(pred_values):
+        if np.max(ref_values) >= 400 or np.max(pred_values) >= 400:
+            raise Exception("Predicted or reference BG values are above valid range.")
+        if np.min(ref_values) <= 0 or np.min(pred_values) <= 0:
+            raise Exception("Predicted or reference BG values are below valid range.")
+    return clarke_zones(ref_values, pred_values)
+
+
+def rmse(actual, pred, axis=None):
+    actual = np.asarray(actual, dtype=float)
+    pred = np.asarray(pred, dtype=float)
+    result = np.sqrt(np.mean((actual - pred) ** 2, axis=axis))
+    return float(result) if axis is None else result
+
+
+def mae(actual, pred, axis=None):
+    actual = np.asarray(actual, dtype=float)
+    pred = np.asarray(pred, dtype=float)
+    result = np.mean(np.abs(actual - pred), axis=axis)
+    return float(result) if axis is None else result
+
+
+# Time in range bounds [mg/dl]
+RANGE_LOW = 70
+RANGE_HIGH = 180
+
+
+def time_in_range(values, axis=None, low=RANGE_LOW, high=RANGE_HIGH):
+    """
+    :return: Shares of values below, within and above the range
+    """
+    values = np.asarray(values, dtype=float)
+    return (np.mean(values < low, axis=axis), np.mean((values >= low) & (values <= high), axis=axis),
+            np.mean(values > high, axis=axis))
+
+
+def evaluate_predictions(actual, pred):
+    """
+    :param actual: Reference BG values [mg/dl]
+    :param pred: Predicted BG values [mg/dl]
+    :return: Dictionary with rmse, mae, the zone shares zone_a ... zone_e, zone_ab (A and B together) and the
+    predicted time below, in and above range
+    """
+    actual = np.ravel(actual)
+    pred = np.ravel(pred)
+    zones = clarke_zones(actual, pred)
+    results = {"rmse": rmse(actual, pred), "mae": mae(actual, pred)}
+    results.update({f"zone_{zone.lower()}": share for zone, share in zip(ZONES, zones)})
+    results["zone_ab"] = zones[0] + zones[1]
+    below, within, above = time_in_range(pred) if len(pred) else (0.0, 0.0, 0.0)
+    results.update({"time_below_range": float(below), "time_in_range": float(within),
+                    "time_above_range": float(above)})
+    return results
+
+
+def evaluate_batch(actual, predictions):
+    """
+    Evaluates the predictions of many models (or tuner trials) of the same reference values in one pass
+    :param actual: Reference BG values [mg/dl], shape (N,)
+    :param predictions: Dictionary of name and predictions of shape (N,), or an array of shape (models, N)
+    :return: DataFrame with one row of evaluate_predictions results per model
+    """
+    import pandas as pd
+
+    if isinstance(predictions, dict):
+        names = list(predictions)
+        pred = np.stack([np.ravel(predictions[name]) for name in names])
+    else:
+        pred = np.atleast_2d(np.asarray(predictions))
+        names = list(range(len(pred)))
+    actual = np.ravel(actual)
+
+    shares = zone_shares(zone_array(actual[np.newaxis], pred))
+    below, within, above = time_in_range(pred, axis=1)
+    results = pd.DataFrame({
+        "rmse": rmse(actual[np.newaxis], pred, axis=1),
+        "mae": mae(actual[np.newaxis], pred, axis=1),
+        **{f"zone_{zone.lower()}": shares[:, i] for i, zone in enumerate(ZONES)},
+        "zone_ab": shares[:, 0] + shares[:, 1],
+        "time_below_range": below,
+        "time_in_range": within,
+        "time_above_range": above,
+    }, index=pd.Index(names, name="model"))
+    return results
+
+
+def denormalize_glucose(norm_val, scaler, glucose_index=0, unit_to="mgdl"):
+    """
+    Inverse of the min-max normalization of the Glucose feature, like bg_denormalize in the notebook
+    :param norm_val: Normalized values
+    :param scaler: MinMaxScaler fitted on the training features
+    :param glucose_index: Position of Glucose in the scaler features
+    """
+    from my_functions import MMOL_TO_MGDL
+
+    d_max, d_min = scaler.data_max_[glucose_index], scaler.data_min_[glucose_index]
+    orig = np.asarray(norm_val) * (d_max - d_min) + d_min
+    if unit_to == "mgdl":
+        orig = orig * MMOL_TO_MGDL
+    return orig
+
+
+def cega_results(labels, predictions, scaler, glucose_index=0):
+    """
+    get_cega_results of the notebook on whole arrays
+    :param labels: Normalized glucose labels
+    :param predictions: Normalized glucose predictions
+    :return: Percentage of points within CEGA zones
+    """
+    actual = denormalize_glucose(np.ravel(labels), scaler, glucose_index)
+    pred = denormalize_glucose(np.ravel(predictions), scaler, glucose_index)
+    return clarke_error_grid(actual, pred)
+
+
+def parse_model_name(name):
+    """
+    Model names in models/ are <type>_<horizon>_<feature>_<feature>..., e.g.
+    "lstm_2h_Glucose_Rapid Insulin IOB_Carbohydrates"
+    :return: Tuple of model type, horizon and feature columns
+    """
+    parts = name.split("_")
+    if len(parts) < 3:
+        raise Exception(f"Model name {name} is not <type>_<horizon>_<features>")
+    return parts[0], parts[1], parts[2:]
+
+
+def evaluation_set(pipeline, columns, horizon, input_width=20, split="test"):
+    """
+    Windows of a normalized split with the true glucose value at the horizon
+    :param pipeline: FeaturePipeline
+    :param columns: Model input columns, must contain Glucose
+    :param horizon: Prediction horizon, e.g. "2h", see windowing.HORIZONS
+    :return: Tuple of inputs (N, input_width, features) and normalized labels (N,)
+    """
+    from windowing import HORIZONS
+
+    inputs, labels, mask = pipeline.windows(columns, input_width, HORIZONS[horizon], split)
+    return np.ascontiguousarray(inputs[mask]), np.asarray(labels[mask])
+
+
+# Largest allowed degradation of a reduced-precision model compared to the float32 model: relative increase of
+# RMSE and absolute decrease of the zone A and zone A+B shares
+GATE_TOLERANCES = {
+    "rmse": 0.02,
+    "zone_a": 0.005,
+    "zone_ab": 0.001,
+}
+
+
+def accuracy_gate(reference, candidate, tolerances=GATE_TOLERANCES):
+    """
+    :param reference: evaluate_predictions results of the float32 model
+    :param candidate: evaluate_predictions results of the model under test
+    :param tolerances: See GATE_TOLERANCES
+    :return: Dictionary with passed, the failed checks and both results
+    """
+    failed = []
+    if candidate["rmse"] > reference["rmse"] * (1 + tolerances["rmse"]):
+        failed.append("rmse")
+    for zone in ["zone_a", "zone_ab"]:
+        if candidate[zone] < reference[zone] - tolerances[zone]:
+            failed.append(zone)
+    return {
+        "passed": not failed,
+        "failed": failed,
+        "reference": reference,
+        "candidate": candidate,
+        "tolerances": dict(tolerances),
+    }
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+# Derived features computed as column operations. The *_rowwise functions are the original DataFrame.apply
+# implementations, kept as the reference for test_features.py.
+
+GI_VALUES = ["Low", "Medium", "High", "Very High"]
+
+
+def derive_hour(time):
+    """
+    :param time: Series of timestamps
+    :return: Hour of the day, int64 like the row-wise version (dt.hour alone is int32)
+    """
+    return time.dt.hour.astype(np.int64)
+
+
+def filter_gi(gi):
+    """
+    Keeps only recognized glycemic index descriptions, anything else becomes NaN
+    """
+    return gi.where(gi.isin(GI_VALUES), np.nan)
+
+
+def combine_rapid_insulin(meal, correction):
+    """
+    Meal insulin if it was recorded, correction insulin otherwise
+    """
+    return meal.where(meal.notna(), correction)
+
+
+def derive_hour_rowwise(df):
+    return df.apply(lambda row: row["Time"].hour, axis=1)
+
+
+def filter_gi_rowwise(df):
+    return df.apply(lambda row: row["GI"] if row["GI"] in GI_VALUES else np.nan, axis=1)
+
+
+def combine_rapid_insulin_rowwise(df):
+    return df[["Insulin (Meal)", "Insulin (Correction)"]].apply(
+        lambda x: x["Insulin (Correction)"] if np.isnan(x["Insulin (Meal)"]) else x["Insulin (Meal)"], axis=1
+    )
@@ -0,0 +1,262 @@
+import os
+import json
+import queue
+import shutil
+import argparse
+import threading
+import numpy as np
+
+from windowing import build_windows, HORIZONS
+
+# Training datasets on disk: the normalized features of every split (and every patient) are stored back to back in
+# one features.npy matrix, <split>_windows.npy hold the start rows of the valid windows. Training maps the files
+# and gathers shuffled batches in a background thread, so datasets don't have to fit in memory and windows aren't
+# built again every epoch:
+#   python mmap_dataset.py export data/windows_2h --horizon 2h
+#   python mmap_dataset.py train data/windows_2h --epochs 60
+
+INPUT_WIDTH = 20
+DEFAULT_COLUMNS = ["Glucose", "Rapid Insulin IOB", "Carbohydrates"]
+SPLITS = ["train", "val", "test"]
+# Rows copied at a time when the segments are assembled into features.npy
+COPY_ROWS = 1 << 20
+
+
+class MmapDatasetWriter:
+    def __init__(self, path, columns=DEFAULT_COLUMNS, input_width=INPUT_WIDTH, shift=HORIZONS["2h"]):
+        """
+        Writes a memory-mapped dataset, one add call per patient
+        :param path: Dataset directory
+        :param columns: Feature columns, in order, must contain Glucose
+        :param input_width: Number of input samples
+        :param shift: Prediction horizon in samples
+        """
+        self.path = path
+        self.columns = list(columns)
+        self.input_width = input_width
+        self.shift = shift
+        self.label_column = self.columns.index("Glucose")
+        self._tmp_path = f"{path}.tmp{os.getpid()}"
+        os.makedirs(self._tmp_path, exist_ok=True)
+        self._segments = []
+        self._rows = 0
+        self._windows = {split: [] for split in SPLITS}
+        self._sources = []
+
+    def add(self, frames, source=None):
+        """
+        :param frames: Dictionary of split name and normalized DataFrame (or (time, features) array), e.g. of one
+        patient. Windows never cross frames.
+        :param source: Description of the frames kept in the metadata, e.g. the patient
+        """
+        for split, frame in frames.items():
+            if split not in SPLITS:
+                raise Exception(f"Split {split} not recognized, use any of {SPLITS}")
+            _, _, mask = build_windows(frame, self.input_width, self.shift, columns=self.columns,
+                                       label_column=self.label_column)
+            values = np.ascontiguousarray(frame[self.columns].to_numpy(dtype=np.float32)) \
+                if hasattr(frame, "columns") else np.ascontiguousarray(frame, dtype=np.float32)
+            # Each segment goes to its own file first, so only one patient's data is in memory at a time
+            segment = os.path.join(self._tmp_path, f"segment_{len(self._segments):05d}.npy")
+            np.save(segment, values)
+            self._segments.append((segment, len(values)))
+            self._windows[split].append(np.flatnonzero(mask).astype(np.int64) + self._rows)
+            self._rows += len(values)
+        self._sources.append(source)
+
+    def add_pipeline(self, pipeline, source=None):
+        """
+        Adds the normalized splits of a FeaturePipeline
+        """
+        train_df, val_df, test_df, _ = pipeline.normalize()
+        self.add({"train": train_df, "val": val_df, "test": test_df}, source)
+
+    def close(self):
+        """
+        Assembles features.npy and writes the window indices and meta.json
+        :return: Dataset directory
+        """
+        features = np.lib.format.open_memmap(os.path.join(self._tmp_path, "features.npy"), mode="w+",
+                                             dtype=np.float32, shape=(self._rows, len(self.columns)))
+        row = 0
+        for segment, rows in self._segments:
+            values = np.load(segment, mmap_mode="r")
+            for start in range(0, rows, COPY_ROWS):
+                chunk = values[start:start + COPY_ROWS]
+                features[row + start:row + start + len(chunk)] = chunk
+            row += rows
+            del values
+            os.remove(segment)
+        features.flush()
+        del features
+
+        counts = {}
+        for split, windows in self._windows.items():
+            windows = np.concatenate(windows) if windows else np.empty(0, dtype=np.int64)
+            np.save(os.path.join(self._tmp_path, f"{split}_windows.npy"), windows)
+            counts[split] = len(windows)
+        with open(os.path.join(self._tmp_path, "meta.json"), "w") as f:
+            json.dump({"columns": self.columns, "input_width": self.input_width, "shift": self.shift,
+                       "label_column": self.label_column, "rows": self._rows, "windows": counts,
+                       "sources": self._sources}, f, indent=2)
+
+        # Replace an older export only once the new one is complete
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self._tmp_path, self.path)
+        return self.path
+
+
+def export_dataset(path, pipelines, columns=DEFAULT_COLUMNS, horizon="2h", input_width=INPUT_WIDTH):
+    """
+    :param pipelines: FeaturePipelines, e.g. one per patient
+    :return: Dataset directory
+    """
+    writer = MmapDatasetWriter(path, columns, input_width, HORIZONS[horizon])
+    for i, pipeline in enumerate(pipelines):
+        writer.add_pipeline(pipeline, source=f"pipeline {i}")
+    return writer.close()
+
+
+class MmapDataset:
+    def __init__(self, path):
+        """
+        Memory-mapped dataset written by MmapDatasetWriter
+        :param path: Dataset directory
+        """
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.input_width = self.meta["input_width"]
+        self.shift = self.meta["shift"]
+        self.label_column = self.meta["label_column"]
+        self.features = np.load(os.path.join(path, "features.npy"), mmap_mode="r")
+        self.windows = {split: np.load(os.path.join(path, f"{split}_windows.npy")) for split in SPLITS}
+        self._offsets = np.arange(self.input_width)
+
+    def __len__(self):
+        return len(self.windows["train"])
+
+    def gather(self, starts):
+        """
+        :param starts: Window start rows
+        :return: Tuple of inputs (N, input_width, features) and labels (N, 1)
+        """
+        # Reading the rows in file order keeps the page cache access sequential
+        starts = np.sort(starts)
+        inputs = self.features[starts[:, np.newaxis] + self._offsets]
+        labels = self.features[starts + self.input_width + self.shift - 1, self.label_column]
+        return inputs, labels.reshape(-1, 1)
+
+    def batch_starts(self, split="train", batch_size=32, shuffle=True, seed=None):
+        """
+        :return: List of window start arrays, one per batch
+        """
+        windows = self.windows[split]
+        if shuffle:
+            windows = np.random.default_rng(seed).permutation(windows)
+        return [windows[i:i + batch_size] for i in range(0, len(windows), batch_size)]
+
+    def batches(self, split="train", batch_size=32, shuffle=True, seed=None, prefetch=4):
+        """
+        Yields the batches of one epoch, gathered ahead in a background thread
+        :param prefetch: Number of batches gathered ahead
+        """
+        batch_starts = self.batch_starts(split, batch_size, shuffle, seed)
+        ready = queue.Queue(maxsize=max(prefetch, 1))
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for starts in batch_starts:
+                    if stop.is_set():
+                        return
+                    ready.put(self.gather(starts))
+            except Exception as e:
+                ready.put(e)
+                return
+            ready.put(None)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                batch = ready.get()
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            # Unblock the producer if it waits on a full queue
+            while producer.is_alive():
+                try:
+                    ready.get_nowait()
+                except queue.Empty:
+                    producer.join(0.01)
+
+    def tf_dataset(self, split="train", batch_size=32, shuffle=True, seed=None, prefetch=4):
+        """
+        tf.data pipeline over batches, reshuffled every epoch
+        """
+        import tensorflow as tf
+
+        n_features = self.features.shape[1]
+        epoch = [0]
+
+        def generate():
+            epoch_seed = None if seed is None else seed + epoch[0]
+            epoch[0] += 1
+            yield from self.batches(split, batch_size, shuffle, epoch_seed, prefetch)
+
+        return tf.data.Dataset.from_generator(generate, output_signature=(
+            tf.TensorSpec(shape=(None, self.input_width, n_features), dtype=tf.float32),
+            tf.TensorSpec(shape=(None, 1), dtype=tf.float32),
+        )).prefetch(tf.data.AUTOTUNE)
+
+
+def train(path, epochs=60, batch_size=16, units=32, dropout=0.05, learning_rate=0.01, patience=2, output=None):
+    """
+    Trains the notebook's LSTM model on a memory-mapped dataset
+    :param output: Where to save the model, e.g. models/lstm_2h_Glucose_Rapid Insulin IOB_Carbohydrates.keras
+    :return: Trained Keras model
+    """
+    import tensorflow as tf
+    import keras_tuner as kt
+    from tuning import build_lstm_model
+
+    dataset = MmapDataset(path)
+    hp = kt.HyperParameters()
+    hp.values.update({"units": units, "dropout": dropout, "learning_rate": learning_rate})
+    model = build_lstm_model(hp)
+    early_stopping = tf.keras.callbacks.EarlyStopping(monitor="val_loss", patience=patience, mode="min")
+    model.fit(dataset.tf_dataset("train", batch_size), epochs=epochs,
+              validation_data=dataset.tf_dataset("val", 1024, shuffle=False), callbacks=[early_stopping])
+    if output:
+        model.save(output)
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export and train on memory-mapped window datasets")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--horizon", choices=list(HORIZONS), default="2h")
+    export_parser.add_argument("--columns", nargs="+", default=DEFAULT_COLUMNS)
+    train_parser = commands.add_parser("train")
+    train_parser.add_argument("path")
+    train_parser.add_argument("--epochs", type=int, default=60)
+    train_parser.add_argument("--batch-size", type=int, default=16)
+    train_parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        from my_functions import FeaturePipeline
+
+        path = export_dataset(args.path, [FeaturePipeline()], args.columns, args.horizon)
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            print(f"Exported {json.load(f)['windows']} windows to {path}")
+    else:
+        train(args.path, args.epochs, args.batch_size, output=args.output)
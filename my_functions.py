@@ -1,64 +1,37 @@
 import os
-import os
 os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'  # Disable oneDNN custom operations
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-import math
+import json
+import functools
 import pandas as pd
 import numpy as np
-import tensorflow as tf
-import sklearn
-from sklearn import preprocessing
-from tensorflow.keras import layers
-import keras
-import seaborn as sns
-import matplotlib.pyplot as plt
-
-# Plotting style
-
-from dataset import load_reader_dataset, load_mySugr_dataset, load_fitbit_dataset
-
-# ## Load data from data sources
-
-df = load_reader_dataset()
 
-mysugr_df = load_mySugr_dataset()
+from dataset import load_reader_dataset, load_mySugr_dataset, load_fitbit_dataset, \
+    load_fitbit_sleep_dataset, load_fitbit_stress_dataset, load_fitbit_oxygen_dataset
+from insulin import InsulinProfile, insulin_on_board_series
+from features import derive_hour, filter_gi
+from compact import compact_frame, expand_frame, frame_memory, frame_rows
+from windowing import build_windows
 
-fitbit_df = load_fitbit_dataset()
-df = pd.concat([df, mysugr_df], ignore_index=True)
+# Importing this module doesn't load or compute anything, the data is prepared by FeaturePipeline stages
+# on first access. The old module level results (train_df, min_max_scaler, ...) are still available and are
+# computed lazily by a shared default pipeline, see __getattr__ at the bottom.
 
-df = pd.concat([df, fitbit_df], ignore_index=True)
-
-df.sort_values(by='Time', inplace=True)
+MMOL_TO_MGDL = 18.016
 
 # Keeping relevant features
-using_features = ['Time', 'Glucose', 'Rapid Insulin', 'Long Insulin', 'Carbohydrates', 'GI', 'calories', 'bpm', 'distance']
-glucose_df = df[using_features]
-glucose_df = glucose_df.dropna(subset=using_features, how='all')
+RAW_FEATURES = ['Time', 'Glucose', 'Rapid Insulin', 'Long Insulin', 'Carbohydrates', 'GI', 'calories', 'bpm', 'distance']
+# Features after deriving Hour and Glycemic Load (replacing GI), the 6 day insulin sum and IOB
+FEATURES = ['Time', 'Glucose', 'Rapid Insulin', 'Long Insulin', 'Carbohydrates', 'calories', 'bpm', 'distance',
+            'Hour', 'Glycemic Load', 'Rapid Insulin 6d', 'Rapid Insulin IOB']
+# Optional Fitbit sleep, stress and oxygen features (FeaturePipeline(fitbit_extras=True)). Daily values are
+# carried forward for a day after they're recorded, oxygen variation is averaged like bpm.
+DAILY_FEATURES = ['temperature', 'hrv', 'nrem bpm', 'hrv entropy', 'respiratory rate', 'stress score']
+EXTRA_FEATURES = DAILY_FEATURES + ['oxygen variation']
 
 # Filtering date range
 start_date = "2021/12/01 00:00"
 end_date = "2022/04/08 00:00"
-glucose_df = glucose_df[(glucose_df["Time"] <= end_date) & (glucose_df["Time"] >= start_date)]
-
-
-glucose_only = glucose_df[["Glucose", "Time"]].dropna()
-deltas = glucose_only['Time'].diff()
-gaps = deltas[deltas > pd.Timedelta(minutes=20)]
-
-
-
-ph_only = glucose_df[["Time", "distance", "calories", "bpm"]].copy().set_index('Time').resample('15T').agg(
-    {
-        'bpm':pd.Series.mean,
-        'distance':pd.Series.mean,
-        'calories':pd.Series.mean,
-    }).reset_index()
-total_ph_not_null = len(ph_only)
-glucose_df["Hour"] = glucose_df.apply(lambda row: row["Time"].hour, axis=1)
-using_features.append("Hour")
-
-GI_valus = ["Low", "Medium", "High", "Very High"]
-glucose_df["GI"] = glucose_df.apply(lambda row: row["GI"] if row["GI"] in GI_valus else np.nan, axis=1)
 
 # Encode as ordinal features
 enc = {
@@ -68,16 +41,21 @@ enc = {
     "Very High": 95,
     np.nan: 0
 }
-glucose_df["GI"] = glucose_df["GI"].map(enc)
 
-# What we realy want to use is Glycemic load, calculated as (GI * grams_of_carbohydrates) / 100
-glucose_df["Glycemic Load"] = glucose_df["GI"] * glucose_df["Carbohydrates"] / 100
+ORIG_FREQ = 15
+SAMPL_FREQ = 15
+FREQ_CORRECTION = ORIG_FREQ // SAMPL_FREQ
+
+days = 6
 
-using_features.remove("GI")
-using_features.append("Glycemic Load")
+# Default insulin profile, the curves are in insulin.py
+# Time duration [minutes] , 3-6 hours for Fiasp
+td = 5*60
+# Peak activity time [minutes], 45-85 minutes
+tp = 55
 
 
-def resample_data(in_df, min_freq=15):
+def resample_data(in_df, min_freq=15, extra_features=()):
     resampl_df = in_df.copy()
     resampl_df = resampl_df.set_index('Time').resample(f'{min_freq}T').agg(
         {
@@ -89,81 +67,16 @@ def resample_data(in_df, min_freq=15):
             'bpm':pd.Series.mean,
             'distance':pd.Series.sum,
             'calories':pd.Series.sum,
-            'Hour':pd.Series.mean
+            'Hour':pd.Series.mean,
+            **{feature: pd.Series.mean for feature in extra_features}
         }).reset_index()
     return resampl_df
 
-ORIG_FREQ = 15
-SAMPL_FREQ = 15
-FREQ_CORRECTION = ORIG_FREQ // SAMPL_FREQ
-
-glucose_df_resampled = resample_data(glucose_df, SAMPL_FREQ)
-
-days = 6
-roll_window_width = days * 24 * 60 // SAMPL_FREQ
-glucose_df_resampled['Rapid Insulin 6d'] = (glucose_df_resampled['Rapid Insulin'].rolling(roll_window_width).sum() / days)
-glucose_df_resampled['Rapid Insulin 6d'].replace(to_replace=np.nan, method='bfill', inplace=True)
-
-using_features.append('Rapid Insulin 6d')
-
-# Long insulin acts for approximately 24 hours, stretch the data across this period
-glucose_df_resampled['Long Insulin'].replace(to_replace=0, method='ffill', inplace=True)
 
-
-td = 5*60
-# Peak activity time [minutes], 45-85 minutes
-tp = 55
-# Time constant of exponential decay
-tau = tp*(1-tp/td)/(1-2*tp/td)
-# Rise time factor
-a = 2*tau/td
-# Auxiliary scale factor
-S = 1/(1-a+(1+a)*math.exp(-td/tau))
-
-# Insulin activity function of time
-# Ia(t) = (S/tau^2)*t*(1-t/td)*exp(-t/tau)
-def insulin_activity(t):
-    return (S/tau**2)*t*(1-t/td)*math.exp(-t/tau)
-
-# Insulin on board function
-# IOB(t) = 1-S*(1-a)*((t^2/(tau*td*(1-a)) - t/tau - 1)*exp(-t/tau)+1)
-def insulin_on_board(t):
-    return 1-S*(1-a)*( (t**2/(tau*td*(1-a)) - t/tau - 1)*math.exp(-t/tau)+1)
-
-# 
-iob = [insulin_on_board(x) for x in range(0, td)]
-ia = [insulin_activity(x) for x in range(0, td)]
-
-
-def insulin_on_board_vector(iob_window, dose):
-    w_len = len(iob_window)
-    result = [current_iob for current_iob in iob_window]
-    for i in range(w_len):
-        result[i] += dose * insulin_on_board(i * SAMPL_FREQ)
-    return result
-
-glucose_df_resampled["Rapid Insulin IOB"] = 0
-
-max_n = len(glucose_df_resampled)
-
-duration_samples = td // SAMPL_FREQ
-for idx, data in glucose_df_resampled.iterrows():
-    # Insulin injected
-    if data["Rapid Insulin"] != 0:
-        idx = int(idx)
-        dur_end = int(min(idx + duration_samples, max_n))
-        ins_dose = data["Rapid Insulin"]
-        glucose_df_resampled.loc[slice(int(idx), dur_end), "Rapid Insulin IOB"] = \
-            insulin_on_board_vector(glucose_df_resampled.loc[slice(int(idx), dur_end), "Rapid Insulin IOB"], ins_dose)
-
-using_features.append("Rapid Insulin IOB")
-MMOL_TO_MGDL = 18.016
 def train_val_test_split(df_in):
     n = len(df_in)
     return df_in[0:int(n*0.7)].copy(), df_in[int(n*0.7):int(n*0.9)].copy(), df_in[int(n*0.9):].copy(), n
 
-train_df, val_df, test_df, n = train_val_test_split(glucose_df_resampled)
-num_features = glucose_df_resampled.shape[1]
 
 def interpolate_gaps(in_df, method="linear"):
     if method in ["spline", "polynomial"]:
@@ -175,13 +88,10 @@ def interpolate_gaps(in_df, method="linear"):
         if "bpm" in in_df.columns:
             in_df["bpm"] = in_df["bpm"].interpolate(method=method)
 
-interpolate_gaps(train_df)
-interpolate_gaps(val_df)
-
-# Drop any nans from test dataset (we're not interpolating it to keep original data)
-test_df = test_df.dropna(subset=["Glucose"])
 
 def min_max_normalize(train_df, val_df, test_df, features):
+    from sklearn import preprocessing
+
     min_max_scaler = preprocessing.MinMaxScaler()
     train_df[features] = min_max_scaler.fit_transform(train_df[features])
 
@@ -189,7 +99,19 @@ def min_max_normalize(train_df, val_df, test_df, features):
     test_df[features] = min_max_scaler.transform(test_df[features])
     return min_max_scaler
 
-min_max_scaler = min_max_normalize(train_df, val_df, test_df, [col for col in using_features if col != "Time"])
+
+def scaler_params(min_max_scaler, features):
+    """
+    :param min_max_scaler: MinMaxScaler fitted by min_max_normalize
+    :param features: Features the scaler was fitted on, in order
+    :return: JSON serializable minimum and maximum of every feature, e.g. for app.patient_state
+    """
+    return {
+        "features": {
+            feature: {"min": float(d_min), "max": float(d_max)}
+            for feature, d_min, d_max in zip(features, min_max_scaler.data_min_, min_max_scaler.data_max_)
+        }
+    }
 
 
 def bg_denormalize(norm_val, unit_to="mgdl"):
@@ -199,5 +121,233 @@ def bg_denormalize(norm_val, unit_to="mgdl"):
     return orig
 
 
+def _stage(method):
+    """
+    Computes the stage on first call and returns the memoized result afterwards. Stages never modify the
+    results of earlier stages, so a memoized result can be shared.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self):
+        if name not in self._results:
+            result = method(self)
+            if self.compact and name in self.COMPACT_STAGES:
+                result = {key: compact_frame(value) for key, value in result.items()} \
+                    if isinstance(result, dict) else compact_frame(result)
+            self._results[name] = result
+        return self._results[name]
+    return wrapper
+
+
+class FeaturePipeline:
+    STAGES = ["load", "merge", "filter", "derive", "resample", "iob", "split", "normalize"]
+    # Raw, mostly empty frames which are kept compacted when compact=True
+    COMPACT_STAGES = ["load", "merge", "filter", "derive"]
+
+    def __init__(self, start_date=start_date, end_date=end_date, sampl_freq=SAMPL_FREQ,
+                 insulin_profile=InsulinProfile(td, tp), use_cache=True, compact=False, fitbit_extras=False):
+        """
+        Prepares the glucose dataset in named stages, each stage is computed lazily and only once
+        :param start_date: First timestamp kept by the filter stage
+        :param end_date: Last timestamp kept by the filter stage
+        :param sampl_freq: Sampling period of the resampled frame [minutes]
+        :param insulin_profile: Insulin profile used for the Rapid Insulin IOB feature
+        :param use_cache: Use the on-disk cache of the dataset loaders
+        :param compact: Keep the load, merge, filter and derive results as float32/categorical/sparse frames, later
+        stages expand them again (with float32 precision)
+        :param fitbit_extras: Also load the Fitbit sleep, stress and oxygen exports and add EXTRA_FEATURES
+        """
+        self.start_date = start_date
+        self.end_date = end_date
+        self.sampl_freq = sampl_freq
+        self.insulin_profile = insulin_profile
+        self.use_cache = use_cache
+        self.compact = compact
+        self.fitbit_extras = fitbit_extras
+        self.extra_features = list(EXTRA_FEATURES) if fitbit_extras else []
+        self.using_features = list(FEATURES) + self.extra_features
+        self._results = {}
+
+    def computed_stages(self):
+        return [stage for stage in self.STAGES if stage in self._results]
+
+    def memory_report(self):
+        """
+        :return: Rows and memory held by every computed stage
+        """
+        return pd.DataFrame(
+            [(stage, frame_rows(self._results[stage]), frame_memory(self._results[stage]) / 2**20)
+             for stage in self.computed_stages()],
+            columns=["stage", "rows", "memory [MiB]"])
+
+    def _dense(self, df):
+        return expand_frame(df) if self.compact else df
+
+    def reset(self, from_stage="load"):
+        """
+        Forgets the results of from_stage and of all the stages after it
+        """
+        for stage in self.STAGES[self.STAGES.index(from_stage):]:
+            self._results.pop(stage, None)
+
+    @_stage
+    def load(self):
+        """
+        :return: Dictionary with the reader, mysugr and fitbit frames (and sleep, stress and oxygen with fitbit_extras)
+        """
+        loaded = {
+            "reader": load_reader_dataset(use_cache=self.use_cache),
+            "mysugr": load_mySugr_dataset(use_cache=self.use_cache),
+            "fitbit": load_fitbit_dataset(use_cache=self.use_cache),
+        }
+        if self.fitbit_extras:
+            loaded["sleep"] = load_fitbit_sleep_dataset(use_cache=self.use_cache)
+            loaded["stress"] = load_fitbit_stress_dataset(use_cache=self.use_cache)
+            loaded["oxygen"] = load_fitbit_oxygen_dataset(use_cache=self.use_cache)
+        return loaded
+
+    @_stage
+    def merge(self):
+        loaded = {key: self._dense(value) for key, value in self.load().items()}
+        df = pd.concat([loaded["reader"], loaded["mysugr"]], ignore_index=True)
+        df = pd.concat([df, loaded["fitbit"]], ignore_index=True)
+        if self.fitbit_extras:
+            df = pd.concat([df, loaded["sleep"], loaded["stress"], loaded["oxygen"]], ignore_index=True)
+        df.sort_values(by='Time', inplace=True)
+        return df
+
+    @_stage
+    def filter(self):
+        raw_features = RAW_FEATURES + self.extra_features
+        glucose_df = self._dense(self.merge())[raw_features]
+        glucose_df = glucose_df.dropna(subset=raw_features, how='all')
+        return glucose_df[(glucose_df["Time"] <= self.end_date) & (glucose_df["Time"] >= self.start_date)]
+
+    @_stage
+    def derive(self):
+        glucose_df = self._dense(self.filter()).copy()
+        glucose_df["Hour"] = derive_hour(glucose_df["Time"])
+        glucose_df["GI"] = filter_gi(glucose_df["GI"]).map(enc)
+        # What we realy want to use is Glycemic load, calculated as (GI * grams_of_carbohydrates) / 100
+        glucose_df["Glycemic Load"] = glucose_df["GI"] * glucose_df["Carbohydrates"] / 100
+        return glucose_df
+
+    @_stage
+    def resample(self):
+        glucose_df_resampled = resample_data(self._dense(self.derive()), self.sampl_freq, self.extra_features)
+
+        # Create a 6 day rolling window for insulin
+        roll_window_width = days * 24 * 60 // self.sampl_freq
+        glucose_df_resampled['Rapid Insulin 6d'] = (glucose_df_resampled['Rapid Insulin'].rolling(roll_window_width).sum() / days)
+        glucose_df_resampled['Rapid Insulin 6d'] = glucose_df_resampled['Rapid Insulin 6d'].replace(to_replace=np.nan, method='bfill')
+
+        # Long insulin acts for approximately 24 hours, stretch the data across this period
+        glucose_df_resampled['Long Insulin'] = glucose_df_resampled['Long Insulin'].replace(to_replace=0, method='ffill')
+
+        # Daily summaries describe the whole day (or the night before), not only the sample they're stamped at
+        daily_features = [feature for feature in DAILY_FEATURES if feature in self.extra_features]
+        if daily_features:
+            glucose_df_resampled[daily_features] = glucose_df_resampled[daily_features].ffill(limit=24 * 60 // self.sampl_freq)
+        return glucose_df_resampled
+
+    @_stage
+    def iob(self):
+        glucose_df_resampled = self.resample().copy()
+        # Sum of every dose's IOB curve, computed for the whole series at once
+        glucose_df_resampled["Rapid Insulin IOB"] = insulin_on_board_series(
+            glucose_df_resampled["Rapid Insulin"].values, self.sampl_freq, self.insulin_profile)
+        return glucose_df_resampled
+
+    @_stage
+    def split(self):
+        """
+        :return: Train, validation and test frames, train and validation have interpolated gaps
+        """
+        train_df, val_df, test_df, _ = train_val_test_split(self.iob())
+        interpolate_gaps(train_df)
+        interpolate_gaps(val_df)
+
+        # Drop any nans from test dataset (we're not interpolating it to keep original data)
+        test_df = test_df.dropna(subset=["Glucose"])
+        return train_df, val_df, test_df
+
+    @_stage
+    def normalize(self):
+        """
+        :return: Min-max normalized train, validation and test frames and the scaler fitted on train
+        """
+        train_df, val_df, test_df = (split_df.copy() for split_df in self.split())
+        min_max_scaler = min_max_normalize(train_df, val_df, test_df, [col for col in self.using_features if col != "Time"])
+        return train_df, val_df, test_df, min_max_scaler
+
+    @property
+    def min_max_scaler(self):
+        return self.normalize()[3]
+
+    def save_scaler(self, path="models/scaler.json"):
+        """
+        Writes the fitted min-max scaling with the resampling and insulin settings, so serving can build the same
+        features online without the training data
+        """
+        params = scaler_params(self.min_max_scaler, [col for col in self.using_features if col != "Time"])
+        params["sampl_freq"] = self.sampl_freq
+        params["insulin_profile"] = {"td": self.insulin_profile.td, "tp": self.insulin_profile.tp}
+        with open(path, "w") as f:
+            json.dump(params, f, indent=2)
+        return path
+
+    def windows(self, columns, input_width, shift, split="train"):
+        """
+        Windows over one of the normalized splits, gaps and missing values are masked out
+        :param columns: Feature columns, e.g. ["Glucose", "Rapid Insulin IOB", "Carbohydrates"]
+        :param input_width: Number of input samples
+        :param shift: Prediction horizon in samples
+        :param split: "train", "val" or "test"
+        :return: inputs (N, input_width, features), Glucose labels (N,) and mask (N,), see windowing.build_windows
+        """
+        train_df, val_df, test_df, _ = self.normalize()
+        frame = {"train": train_df, "val": val_df, "test": test_df}[split]
+        return build_windows(frame, input_width, shift, columns=columns, label_column=columns.index("Glucose"))
+
+
+_default_pipeline = None
+
+
+def default_pipeline():
+    global _default_pipeline
+    if _default_pipeline is None:
+        _default_pipeline = FeaturePipeline()
+    return _default_pipeline
+
+
+def _gaps(pipeline):
+    glucose_only = pipeline._dense(pipeline.filter())[["Glucose", "Time"]].dropna()
+    deltas = glucose_only['Time'].diff()
+    return deltas[deltas > pd.Timedelta(minutes=20)]
+
+
+# Results which used to be computed when importing the module
+_LAZY_ATTRIBUTES = {
+    "df": lambda p: p.merge(),
+    "mysugr_df": lambda p: p.load()["mysugr"],
+    "fitbit_df": lambda p: p.load()["fitbit"],
+    "glucose_df": lambda p: p.derive(),
+    "glucose_only": lambda p: p._dense(p.filter())[["Glucose", "Time"]].dropna(),
+    "gaps": _gaps,
+    "glucose_df_resampled": lambda p: p.iob(),
+    "using_features": lambda p: p.using_features,
+    "n": lambda p: len(p.iob()),
+    "max_n": lambda p: len(p.iob()),
+    "num_features": lambda p: p.iob().shape[1],
+    "train_df": lambda p: p.normalize()[0],
+    "val_df": lambda p: p.normalize()[1],
+    "test_df": lambda p: p.normalize()[2],
+    "min_max_scaler": lambda p: p.min_max_scaler,
+}
 
 
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        return _LAZY_ATTRIBUTES[name](default_pipeline())
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,473 @@
+import io
+import os
+import json
+import hashlib
+import zipfile
+import re
+import numpy as np
+
+# Forward pass of the Sequential models in models/ with NumPy only. Serving needs neither TensorFlow nor Keras:
+# export_keras_model copies the layer configs and weights out of a .keras file (a zip with config.json and
+# model.weights.h5) into an .npz, load_model builds a NumpyModel from either of them.
+
+SUPPORTED_LAYERS = ["InputLayer", "LSTM", "Dense", "Dropout", "Flatten", "Reshape"]
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    None: lambda x: x,
+    "relu": lambda x: np.maximum(x, 0),
+    "tanh": np.tanh,
+    "sigmoid": sigmoid,
+}
+
+
+def get_activation(name):
+    if name not in ACTIVATIONS:
+        raise Exception(f"Activation {name} not supported, use one of {[a for a in ACTIVATIONS if a]}")
+    return ACTIVATIONS[name]
+
+
+class QuantizedWeight:
+    # int8 kernel with one scale per output column. Matrix products run on the int8 values and are scaled after,
+    # so the model keeps the weights at a quarter of the float32 size.
+    __array_ufunc__ = None
+
+    def __init__(self, stored, scale):
+        self.stored = stored
+        self.scale = np.asarray(scale, dtype=np.float32)
+        self.shape = stored.shape
+        # Dtype of the products
+        self.dtype = np.dtype(np.float32)
+
+    @property
+    def nbytes(self):
+        return self.stored.nbytes + self.scale.nbytes
+
+    def __rmatmul__(self, x):
+        y = x @ self.stored
+        y *= self.scale
+        return y
+
+    def __array__(self, dtype=None):
+        weight = self.stored.astype(np.float32) * self.scale
+        return weight if dtype is None else weight.astype(dtype, copy=False)
+
+
+def served_weight(weight, scale=None, dtype=np.float32):
+    """
+    :return: Weight as the layers use it: int8 weights with their scale as QuantizedWeight, float16 weights as
+    they are, everything else as dtype
+    """
+    if scale is not None:
+        return QuantizedWeight(weight, scale)
+    if isinstance(weight, QuantizedWeight) or (isinstance(weight, np.ndarray) and weight.dtype == np.float16):
+        return weight
+    return np.asarray(weight, dtype=dtype)
+
+
+class Dense:
+    def __init__(self, config, weights):
+        self.kernel = weights[0]
+        self.bias = weights[1] if config.get("use_bias", True) else None
+        self.activation = get_activation(config.get("activation"))
+
+    def __call__(self, x):
+        y = x @ self.kernel
+        if self.bias is not None:
+            y += self.bias
+        return self.activation(y)
+
+
+class LSTM:
+    def __init__(self, config, weights):
+        if config.get("go_backwards") or config.get("stateful") or config.get("return_state"):
+            raise Exception("Only forward, stateless LSTM layers are supported")
+        self.kernel, self.recurrent_kernel = weights[0], weights[1]
+        self.bias = weights[2] if config.get("use_bias", True) else np.zeros(self.kernel.shape[1], np.float32)
+        self.units = config["units"]
+        self.return_sequences = config.get("return_sequences", False)
+        self.activation = get_activation(config.get("activation", "tanh"))
+        self.recurrent_activation = get_activation(config.get("recurrent_activation", "sigmoid"))
+
+    def __call__(self, x):
+        """
+        :param x: Array of shape (batch, time, features)
+        """
+        batch, steps, _ = x.shape
+        units = self.units
+        # Input projections of all time steps in one matrix product, only the recurrent part is sequential
+        projected = x @ self.kernel + self.bias
+        # Reduced-precision recurrent weights are converted once per call, not on every time step
+        recurrent_kernel = np.asarray(self.recurrent_kernel, dtype=x.dtype)
+        h = np.zeros((batch, units), dtype=x.dtype)
+        c = np.zeros((batch, units), dtype=x.dtype)
+        outputs = []
+        for t in range(steps):
+            z = projected[:, t] + h @ recurrent_kernel
+            # Keras gate order: input, forget, cell, output
+            i = self.recurrent_activation(z[:, :units])
+            f = self.recurrent_activation(z[:, units:2 * units])
+            c = f * c + i * self.activation(z[:, 2 * units:3 * units])
+            o = self.recurrent_activation(z[:, 3 * units:])
+            h = o * self.activation(c)
+            if self.return_sequences:
+                outputs.append(h)
+        return np.stack(outputs, axis=1) if self.return_sequences else h
+
+
+class Flatten:
+    def __init__(self, config, weights):
+        pass
+
+    def __call__(self, x):
+        return x.reshape(len(x), -1)
+
+
+class Reshape:
+    def __init__(self, config, weights):
+        self.target_shape = tuple(config["target_shape"])
+
+    def __call__(self, x):
+        return x.reshape((len(x),) + self.target_shape)
+
+
+class Dropout:
+    # Inference only, dropout doesn't change anything
+    def __init__(self, config, weights):
+        pass
+
+    def __call__(self, x):
+        return x
+
+
+LAYERS = {
+    "LSTM": LSTM,
+    "Dense": Dense,
+    "Dropout": Dropout,
+    "Flatten": Flatten,
+    "Reshape": Reshape,
+}
+
+
+class NumpyModel:
+    def __init__(self, layer_configs, layer_weights, input_shape, dtype=np.float32):
+        """
+        :param layer_configs: List of (class name, config) of the layers, without the InputLayer
+        :param layer_weights: List of weight arrays lists, one per layer. float16 arrays and QuantizedWeights are
+        kept as they are, see served_weight.
+        :param input_shape: Model input shape, including the batch dimension as None
+        """
+        self.layer_configs = layer_configs
+        self.input_shape = tuple(input_shape)
+        self.dtype = dtype
+        self.layer_weights = [[served_weight(w, dtype=dtype) for w in weights] for weights in layer_weights]
+        self.layers = [LAYERS[class_name](config, weights)
+                       for (class_name, config), weights in zip(layer_configs, self.layer_weights)]
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the weights
+        """
+        return sum(weight.nbytes for weights in self.layer_weights for weight in weights)
+
+    def predict(self, inputs, **kwargs):
+        """
+        :param inputs: Array of shape input_shape
+        :return: Model output, same shape as keras Model.predict
+        """
+        x = np.asarray(inputs, dtype=self.dtype)
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+    # Same interface as the Keras models used by the model registry
+    predict_on_batch = predict
+
+    def __call__(self, inputs):
+        return self.predict(inputs)
+
+
+def _block_diagonal(blocks):
+    rows = sum(block.shape[0] for block in blocks)
+    cols = sum(block.shape[1] for block in blocks)
+    result = np.zeros((rows, cols), dtype=blocks[0].dtype)
+    row = col = 0
+    for block in blocks:
+        result[row:row + block.shape[0], col:col + block.shape[1]] = block
+        row += block.shape[0]
+        col += block.shape[1]
+    return result
+
+
+def _split_gates(weight, units):
+    return [weight[..., gate * units:(gate + 1) * units] for gate in range(4)]
+
+
+def fuse_models(models):
+    """
+    Fuses LSTM -> Dense models with the same input, e.g. the 30min, 1h and 2h models, into one model. The LSTMs
+    become one wider LSTM with block diagonal recurrent weights, so all the models step through the input
+    sequence together.
+    :param models: NumpyModels made of one LSTM, Dropouts and one Dense layer
+    :return: NumpyModel with the outputs of all the models concatenated along the last axis, None when the
+    models can't be fused
+    """
+    lstms, denses = [], []
+    for model in models:
+        layers = [(layer, config) for layer, (_, config) in zip(model.layers, model.layer_configs)
+                  if not isinstance(layer, Dropout)]
+        if len(layers) != 2 or not isinstance(layers[0][0], LSTM) or not isinstance(layers[1][0], Dense) or \
+                layers[0][0].return_sequences or model.input_shape != models[0].input_shape:
+            return None
+        lstms.append(layers[0])
+        denses.append(layers[1])
+
+    lstm_config = {key: lstms[0][1].get(key, default) for key, default in
+                   [("activation", "tanh"), ("recurrent_activation", "sigmoid")]}
+    dense_config = {"activation": denses[0][1].get("activation")}
+    if any({key: config.get(key, lstm_config[key]) for key in lstm_config} != lstm_config for _, config in lstms) or \
+            any(config.get("activation") != dense_config["activation"] for _, config in denses):
+        return None
+    lstm_config["units"] = sum(lstm.units for lstm, _ in lstms)
+
+    # Keras keeps the gates as consecutive blocks (input, forget, cell, output). The fused weights keep that
+    # order, with the units of all the models next to each other inside each gate.
+    # int8 weights are fused dequantized, their scales are per column of the separate models
+    kernels = [_split_gates(np.asarray(lstm.kernel), lstm.units) for lstm, _ in lstms]
+    recurrent_kernels = [_split_gates(np.asarray(lstm.recurrent_kernel), lstm.units) for lstm, _ in lstms]
+    biases = [_split_gates(lstm.bias, lstm.units) for lstm, _ in lstms]
+    lstm_weights = [
+        np.concatenate([kernel[gate] for gate in range(4) for kernel in kernels], axis=1),
+        np.concatenate([_block_diagonal([kernel[gate] for kernel in recurrent_kernels]) for gate in range(4)], axis=1),
+        np.concatenate([bias[gate] for gate in range(4) for bias in biases]),
+    ]
+    dense_weights = [
+        _block_diagonal([np.asarray(dense.kernel) for dense, _ in denses]),
+        np.concatenate([dense.bias if dense.bias is not None else np.zeros(dense.kernel.shape[1], np.float32)
+                        for dense, _ in denses]),
+    ]
+    return NumpyModel([("LSTM", lstm_config), ("Dense", dense_config)], [lstm_weights, dense_weights],
+                      models[0].input_shape)
+
+
+def _snake_case(name):
+    # Same as keras naming.to_snake_case, e.g. Dense -> dense, LSTM -> lstm
+    name = re.sub(r"(.)([A-Z][a-z]+)", r"\1_\2", name)
+    return re.sub(r"([a-z])([A-Z])", r"\1_\2", name).lower()
+
+
+def _weight_paths(layer_configs):
+    """
+    Keras 3 stores the weights of a Sequential model under layers/<snake case class name>[_<n>]/, numbered per
+    class in layer order, independent of the layer names
+    """
+    counts = {}
+    paths = []
+    for class_name, _ in layer_configs:
+        name = _snake_case(class_name)
+        count = counts.get(name, 0)
+        counts[name] = count + 1
+        paths.append(f"layers/{name}" if count == 0 else f"layers/{name}_{count}")
+    return paths
+
+
+def _read_vars(group):
+    if "vars" not in group:
+        return []
+    return [group["vars"][str(i)][()] for i in range(len(group["vars"]))]
+
+
+def read_keras_model(keras_path):
+    """
+    Reads the layer configs and weights of a .keras file (Keras 3 Sequential model), doesn't need Keras
+    :return: Tuple of layer configs, layer weights and input shape, the arguments of NumpyModel
+    """
+    import h5py
+
+    with zipfile.ZipFile(keras_path) as archive:
+        config = json.loads(archive.read("config.json"))
+        weights_file = io.BytesIO(archive.read("model.weights.h5"))
+
+    if config.get("class_name") != "Sequential":
+        raise Exception(f"Only Sequential models are supported, {keras_path} is a {config.get('class_name')}")
+    layer_configs = []
+    input_shape = None
+    for layer in config["config"]["layers"]:
+        class_name = layer["class_name"]
+        if class_name not in SUPPORTED_LAYERS:
+            raise Exception(f"Layer {class_name} not supported, use one of {SUPPORTED_LAYERS}")
+        if class_name == "InputLayer":
+            input_shape = layer["config"]["batch_shape"]
+            continue
+        if input_shape is None and "build_config" in layer:
+            input_shape = layer["build_config"]["input_shape"]
+        layer_configs.append((class_name, layer["config"]))
+
+    layer_weights = []
+    with h5py.File(weights_file, "r") as weights:
+        for (class_name, _), path in zip(layer_configs, _weight_paths(layer_configs)):
+            group = weights.get(path)
+            if group is None:
+                layer_weights.append([])
+            elif class_name == "LSTM":
+                layer_weights.append(_read_vars(group["cell"]))
+            else:
+                layer_weights.append(_read_vars(group))
+    return layer_configs, layer_weights, input_shape
+
+
+def save_npz_model(npz_path, layer_configs, layer_weights, input_shape, scales=None, quantization=None):
+    """
+    :param scales: Optional per-layer lists of dequantization scales (None for weights stored as they are)
+    :param quantization: Optional metadata of a reduced-precision model, see quantization.py
+    """
+    arrays = {"model_config": np.array(json.dumps({"layers": layer_configs, "input_shape": input_shape}))}
+    if quantization is not None:
+        arrays["quantization"] = np.array(json.dumps(quantization))
+    for i, weights in enumerate(layer_weights):
+        for j, weight in enumerate(weights):
+            arrays[f"layer_{i}/{j}"] = weight
+            if scales is not None and scales[i][j] is not None:
+                arrays[f"layer_{i}/{j}/scale"] = scales[i][j]
+    # Written aside and renamed, so a worker hot reloading the model never reads a partial file
+    tmp_path = npz_path + ".tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, npz_path)
+    return npz_path
+
+
+def export_keras_model(keras_path, npz_path=None):
+    """
+    Writes the configs and weights of a .keras model to an .npz next to it
+    :param keras_path: Path of the .keras file
+    :param npz_path: Output path, defaults to the keras path with the .npz extension
+    :return: Path of the written file
+    """
+    layer_configs, layer_weights, input_shape = read_keras_model(keras_path)
+    return save_npz_model(npz_path or os.path.splitext(keras_path)[0] + ".npz", layer_configs, layer_weights,
+                          input_shape)
+
+
+def read_quantization(npz_path):
+    """
+    :return: Quantization metadata of an .npz model, None for a full precision export
+    """
+    with np.load(npz_path) as arrays:
+        return json.loads(str(arrays["quantization"])) if "quantization" in arrays.files else None
+
+
+def model_fingerprint(model_path):
+    """
+    :return: SHA-256 of a model file, recorded in the artifacts derived from it
+    """
+    with open(model_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_npz_model(npz_path, require_gate=True, source_path=None):
+    """
+    :param require_gate: Refuse reduced-precision models which didn't pass the accuracy gate
+    :param source_path: Model the reduced-precision artifact was built from, refuse the artifact when it was built
+    from another version of it
+    """
+    with np.load(npz_path) as arrays:
+        model_config = json.loads(str(arrays["model_config"]))
+        if "quantization" in arrays.files and (require_gate or source_path):
+            quantization = json.loads(str(arrays["quantization"]))
+            if require_gate and not quantization.get("gate", {}).get("passed"):
+                raise Exception(f"{npz_path} didn't pass the accuracy gate, refusing to serve it")
+            if source_path and quantization.get("source") != model_fingerprint(source_path):
+                raise Exception(f"{npz_path} wasn't built from the current {source_path}, create it again with "
+                                f"quantization.py")
+        layer_configs = [tuple(layer) for layer in model_config["layers"]]
+        layer_weights = [[] for _ in layer_configs]
+        for key in arrays.files:
+            if key.startswith("layer_") and not key.endswith("/scale"):
+                layer, index = key[len("layer_"):].split("/")
+                # Reduced-precision weights stay reduced in memory
+                scale = arrays[key + "/scale"] if key + "/scale" in arrays.files else None
+                layer_weights[int(layer)].append((int(index), served_weight(arrays[key], scale)))
+    layer_weights = [[weight for _, weight in sorted(weights, key=lambda w: w[0])] for weights in layer_weights]
+    return NumpyModel(layer_configs, layer_weights, model_config["input_shape"])
+
+
+def quantized_model_path(model_path, precision):
+    """
+    :return: Path of the reduced-precision artifact of a model, e.g. models/<name>.int8.npz
+    """
+    return os.path.splitext(model_path)[0] + f".{precision}.npz"
+
+
+def load_model(path, precision="float32"):
+    """
+    :param path: .npz export or .keras model. For a .keras model an up to date .npz export next to it is used
+    when there is one, otherwise the weights are read from the .keras file directly.
+    :param precision: "float32", or "float16"/"int8" to load the quantized artifact of a .keras model, which must
+    have passed the accuracy gate and be built from the current .keras file
+    :return: NumpyModel
+    """
+    root, extension = os.path.splitext(path)
+    if extension == ".npz":
+        return load_npz_model(path)
+    if precision != "float32":
+        quantized_path = quantized_model_path(path, precision)
+        if not os.path.exists(quantized_path):
+            raise Exception(f"No {precision} artifact for {path}, create it with quantization.py")
+        return load_npz_model(quantized_path, source_path=path)
+    npz_path = root + ".npz"
+    if os.path.exists(npz_path) and os.path.getmtime(npz_path) >= os.path.getmtime(path):
+        return load_npz_model(npz_path)
+    return NumpyModel(*read_keras_model(path))
+
+
+def check_parity(keras_path, inputs, atol=1e-5):
+    """
+    Compares the NumPy engine with TensorFlow on the same inputs, needs TensorFlow installed
+    :param keras_path: Path of the .keras model
+    :param inputs: Array of model inputs, e.g. the examples of all_test_data.csv
+    :param atol: Largest allowed absolute difference of the (normalized) predictions
+    :return: Largest absolute difference
+    """
+    from tensorflow.keras.models import load_model as load_keras_model
+
+    expected = load_keras_model(keras_path).predict(inputs, verbose=0)
+    actual = load_model(keras_path).predict(inputs)
+    if expected.shape != actual.shape:
+        raise Exception(f"Output shape {actual.shape} differs from TensorFlow's {expected.shape}")
+    max_difference = float(np.max(np.abs(expected - actual)))
+    if max_difference > atol:
+        raise Exception(f"{keras_path} differs from TensorFlow by {max_difference}, more than {atol}")
+    return max_difference
+
+
+def parity_inputs(model, examples):
+    """
+    Test examples shaped for the model input, models with other inputs get random ones of the same range
+    """
+    input_shape = tuple(model.input_shape[1:])
+    if examples.shape[1:] == input_shape:
+        return examples
+    return np.random.default_rng(0).random((len(examples),) + input_shape, dtype=np.float32)
+
+
+if __name__ == "__main__":
+    import sys
+    import pandas as pd
+    from windowing import examples_from_frame
+
+    models_dir = "models"
+    keras_models = sorted(os.path.join(models_dir, f) for f in os.listdir(models_dir) if f.endswith(".keras"))
+    if len(sys.argv) > 1 and sys.argv[1] == "export":
+        for keras_model in keras_models:
+            print("Exported", export_keras_model(keras_model))
+    else:
+        _, examples = examples_from_frame(pd.read_csv("all_test_data.csv"), width=20)
+        for keras_model in keras_models:
+            inputs = parity_inputs(load_model(keras_model), examples)
+            print(f"{keras_model}: max difference {check_parity(keras_model, inputs):.2e}")
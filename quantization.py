@@ -0,0 +1,127 @@
+import time
+import numpy as np
+from numpy_engine import NumpyModel, read_keras_model, save_npz_model, quantized_model_path, model_fingerprint, \
+    served_weight
+from evaluation import evaluate_predictions, accuracy_gate, GATE_TOLERANCES
+
+# Reduced-precision copies of the models in models/. Kernels are stored as float16, or as int8 with one scale per
+# output unit (symmetric, per column), biases stay float32. numpy_engine keeps the kernels in that precision in
+# memory, int8 products are scaled after the matrix product. NumPy has no float16 / int8 BLAS, so this saves
+# memory and disk but isn't faster, measure_model records both next to the accuracy gate. Every artifact carries
+# the result of the accuracy gate and the fingerprint of its .keras model, numpy_engine refuses to load one which
+# didn't pass or was built from an older model.
+
+PRECISIONS = ["float16", "int8"]
+
+
+def quantize_weight(weight, precision):
+    """
+    :param weight: float32 weight array
+    :param precision: "float16" or "int8"
+    :return: Tuple of the stored array and its dequantization scale (None when not needed)
+    """
+    if precision not in PRECISIONS:
+        raise Exception(f"Precision {precision} not recognized, use one of {PRECISIONS}")
+    if weight.ndim < 2:
+        # Biases are tiny and sensitive, keep them as they are
+        return weight, None
+    if precision == "float16":
+        return weight.astype(np.float16), None
+    max_abs = np.max(np.abs(weight), axis=0, keepdims=True)
+    scale = np.where(max_abs > 0, max_abs / 127, 1).astype(np.float32)
+    return np.clip(np.round(weight / scale), -127, 127).astype(np.int8), scale
+
+
+def quantize_model(layer_weights, precision):
+    """
+    :return: Tuple of the stored weights and the scales, both one list per layer
+    """
+    stored, scales = [], []
+    for weights in layer_weights:
+        quantized = [quantize_weight(np.asarray(weight, dtype=np.float32), precision) for weight in weights]
+        stored.append([weight for weight, _ in quantized])
+        scales.append([scale for _, scale in quantized])
+    return stored, scales
+
+
+def measure_model(model, inputs, repeat=50):
+    """
+    :return: Dictionary with the memory held by the weights, and the median predict time of one example and of
+    all the inputs [ms]
+    """
+    def median_ms(batch, times):
+        durations = []
+        for _ in range(times):
+            start = time.perf_counter()
+            model.predict(batch)
+            durations.append(time.perf_counter() - start)
+        return float(np.median(durations)) * 1000
+
+    model.predict(inputs[:1])
+    return {
+        "weight_bytes": int(model.nbytes),
+        "single_ms": median_ms(inputs[:1], repeat),
+        "batch_ms": median_ms(inputs, max(repeat // 10, 3)),
+    }
+
+
+def build_quantized_model(keras_path, precision, inputs, labels, to_mgdl, tolerances=GATE_TOLERANCES):
+    """
+    Quantizes a model, gates it against the float32 model and writes the artifact next to it
+    :param keras_path: Path of the .keras model
+    :param precision: "float16" or "int8"
+    :param inputs: Evaluation inputs, e.g. from evaluation.evaluation_set
+    :param labels: Normalized glucose labels of the inputs
+    :param to_mgdl: Function converting normalized glucose to mg/dl
+    :param tolerances: Allowed degradation, see evaluation.GATE_TOLERANCES
+    :return: Path of the artifact, the gate result and the memory and latency of the float32 ("reference") and
+    the quantized model ("candidate"), see measure_model. The artifact is written also when the gate fails, it
+    records the failure and won't be served.
+    """
+    layer_configs, layer_weights, input_shape = read_keras_model(keras_path)
+    stored, scales = quantize_model(layer_weights, precision)
+    # Same weights as numpy_engine serves from the artifact
+    reference_model = NumpyModel(layer_configs, layer_weights, input_shape)
+    candidate_model = NumpyModel(layer_configs, [[served_weight(weight, scale) for weight, scale in zip(*layer)]
+                                                 for layer in zip(stored, scales)], input_shape)
+
+    actual = to_mgdl(labels)
+    reference = evaluate_predictions(actual, to_mgdl(reference_model.predict(inputs)))
+    candidate = evaluate_predictions(actual, to_mgdl(candidate_model.predict(inputs)))
+    gate = accuracy_gate(reference, candidate, tolerances)
+    footprint = {"reference": measure_model(reference_model, inputs), "candidate": measure_model(candidate_model, inputs)}
+
+    path = save_npz_model(quantized_model_path(keras_path, precision), layer_configs, stored, input_shape, scales,
+                          {"precision": precision, "gate": gate, "footprint": footprint,
+                           "source": model_fingerprint(keras_path)})
+    return path, gate, footprint
+
+
+if __name__ == "__main__":
+    import os
+    from my_functions import FeaturePipeline
+    from evaluation import parse_model_name, evaluation_set, denormalize_glucose
+
+    pipeline = FeaturePipeline()
+    scaler = pipeline.min_max_scaler
+    glucose_index = [col for col in pipeline.using_features if col != "Time"].index("Glucose")
+    models_dir = "models"
+    for file in sorted(os.listdir(models_dir)):
+        if not file.endswith(".keras"):
+            continue
+        model_type, horizon, columns = parse_model_name(os.path.splitext(file)[0])
+        if model_type != "lstm":
+            continue
+        inputs, labels = evaluation_set(pipeline, columns, horizon)
+        for precision in PRECISIONS:
+            path, gate, footprint = build_quantized_model(
+                os.path.join(models_dir, file), precision, inputs, labels,
+                lambda values: denormalize_glucose(values, scaler, glucose_index))
+            reference, candidate = footprint["reference"], footprint["candidate"]
+            print(f"{path}: {'passed' if gate['passed'] else 'FAILED ' + ', '.join(gate['failed'])}, "
+                  f"RMSE {gate['reference']['rmse']:.2f} -> {gate['candidate']['rmse']:.2f} mg/dl, "
+                  f"zone A {gate['reference']['zone_a']:.3f} -> {gate['candidate']['zone_a']:.3f}, "
+                  f"zone A+B {gate['reference']['zone_ab']:.3f} -> {gate['candidate']['zone_ab']:.3f}, "
+                  f"weights {reference['weight_bytes']} -> {candidate['weight_bytes']} bytes, "
+                  f"single {reference['single_ms']:.3f} -> {candidate['single_ms']:.3f} ms, "
+                  f"{len(inputs)} windows {reference['batch_ms']:.1f} -> {candidate['batch_ms']:.1f} ms")
@@ -0,0 +1,212 @@
+import os
+import json
+import shutil
+import hashlib
+import pandas as pd
+import numpy as np
+from data_cache import source_fingerprint, read_frame, write_frame, CACHE_FORMAT
+
+# Persisted, deduplicated LibreView rows, partitioned by month of the reading. The hashes of the rows of every
+# ingested export are kept in exports/, so the rows of a changed export can be replaced.
+STORE_DIR = os.getenv("READER_STORE_DIR", ".cache/reader_store")
+STORE_VERSION = 2
+
+# Read these as text in every export, otherwise an all-empty column comes out as float in one export and as
+# object in another, and identical rows would hash differently
+TEXT_COLUMNS = ['Time', 'Non-numeric Rapid-Acting Insulin', 'Non-numeric Food', 'Non-numeric Long-Acting Insulin',
+                'Notes', 'Previous Time', 'Updated Time']
+
+
+def _manifest_path(store_dir):
+    return os.path.join(store_dir, "manifest.json")
+
+
+def _partition_path(store_dir, partition):
+    extension = "parquet" if CACHE_FORMAT == "parquet" else "pkl"
+    return os.path.join(store_dir, f"{partition}.{extension}")
+
+
+def _export_rows_path(store_dir, export):
+    extension = "parquet" if CACHE_FORMAT == "parquet" else "pkl"
+    return os.path.join(store_dir, "exports", f"{hashlib.sha256(export.encode()).hexdigest()[:16]}.{extension}")
+
+
+def _write_partition(path, rows):
+    tmp_path = path + ".tmp"
+    write_frame(rows.reset_index(drop=True), tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _store_version(store_dir):
+    path = _manifest_path(store_dir)
+    if not os.path.exists(path):
+        return STORE_VERSION
+    with open(path, "r") as f:
+        return json.load(f).get("version")
+
+
+def load_manifest(store_dir=STORE_DIR):
+    path = _manifest_path(store_dir)
+    if not os.path.exists(path):
+        return {"version": STORE_VERSION, "exports": {}}
+    with open(path, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != STORE_VERSION:
+        raise Exception(f"Reader store in {store_dir} has version {manifest.get('version')}, expected "
+                        f"{STORE_VERSION}, rebuild it with rebuild_store()")
+    return manifest
+
+
+def save_manifest(manifest, store_dir=STORE_DIR):
+    tmp_path = _manifest_path(store_dir) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, _manifest_path(store_dir))
+
+
+def read_reader_export(export):
+    """
+    Reads a single LibreView export and keys every row by a hash of all its values, rows with the same
+    hash are exact duplicates (this is what drop_duplicates compared before)
+    """
+    df = pd.read_csv(export, sep="\t", dtype={col: object for col in TEXT_COLUMNS})
+    df["Row Hash"] = pd.util.hash_pandas_object(df, index=False).values
+    # Position within the export, where the row was first seen
+    df["Source Row"] = df.index
+    return df
+
+
+def ingest_export(export, store_dir=STORE_DIR):
+    """
+    Merges a single export into the store. Only the monthly partitions which the export overlaps are read and
+    rewritten, so the cost is proportional to the export and not to the full history.
+    :param export: Path to the LibreView export
+    :param store_dir: Directory holding the store
+    :return: Number of rows which weren't in the store yet
+    """
+    manifest = load_manifest(store_dir)
+    new_rows = read_reader_export(export)
+    new_rows = new_rows.drop_duplicates(subset="Row Hash")
+    partitions = pd.to_datetime(new_rows["Time"], format="%Y/%m/%d %H:%M").dt.strftime("%Y-%m")
+
+    os.makedirs(os.path.join(store_dir, "exports"), exist_ok=True)
+    added = 0
+    for partition, rows in new_rows.groupby(partitions.values, sort=True):
+        path = _partition_path(store_dir, partition)
+        if os.path.exists(path):
+            existing = read_frame(path)
+            # Dedup by key against this month only
+            rows = rows[~rows["Row Hash"].isin(existing["Row Hash"])]
+            if rows.empty:
+                continue
+            added += len(rows)
+            rows = pd.concat([existing, rows], ignore_index=True)
+        else:
+            added += len(rows)
+        _write_partition(path, rows)
+
+    export_rows = pd.DataFrame({"Row Hash": new_rows["Row Hash"].values, "Partition": partitions.values})
+    _write_partition(_export_rows_path(store_dir, export), export_rows)
+    manifest["exports"][export] = source_fingerprint([export], STORE_VERSION)
+    save_manifest(manifest, store_dir)
+    return added
+
+
+def remove_export(export, store_dir=STORE_DIR):
+    """
+    Drops the rows of an ingested export from the store, rows which other ingested exports have as well are kept
+    :return: Number of rows removed
+    """
+    manifest = load_manifest(store_dir)
+    export_rows = read_frame(_export_rows_path(store_dir, export))
+    others = [read_frame(_export_rows_path(store_dir, other))["Row Hash"] for other in manifest["exports"]
+              if other != export]
+    if others:
+        export_rows = export_rows[~export_rows["Row Hash"].isin(pd.concat(others, ignore_index=True))]
+
+    removed = 0
+    for partition, rows in export_rows.groupby("Partition", sort=True):
+        path = _partition_path(store_dir, partition)
+        existing = read_frame(path)
+        kept = existing[~existing["Row Hash"].isin(rows["Row Hash"])]
+        removed += len(existing) - len(kept)
+        if kept.empty:
+            os.remove(path)
+        else:
+            _write_partition(path, kept)
+
+    os.remove(_export_rows_path(store_dir, export))
+    del manifest["exports"][export]
+    save_manifest(manifest, store_dir)
+    return removed
+
+
+def sync_store(exports, store_dir=STORE_DIR):
+    """
+    Ingests every export which is new or changed since it was last ingested, the previously ingested rows of a
+    changed export are dropped first. The store is rebuilt when an ingested export is gone or the store has
+    another version, so it always holds the same rows as reading all the exports.
+    :return: List of ingested exports
+    """
+    if _store_version(store_dir) != STORE_VERSION or \
+            any(export not in exports for export in load_manifest(store_dir)["exports"]):
+        rebuild_store(exports, store_dir)
+        return list(exports)
+
+    manifest = load_manifest(store_dir)
+    ingested = []
+    for export in exports:
+        fingerprint = manifest["exports"].get(export)
+        if fingerprint != source_fingerprint([export], STORE_VERSION):
+            if fingerprint is not None:
+                remove_export(export, store_dir)
+            ingest_export(export, store_dir)
+            ingested.append(export)
+    return ingested
+
+
+def sort_rows(df):
+    """
+    Puts deduplicated rows in one order no matter which export or partition they came from: by time, rows of the
+    same minute by their hash
+    :return: Rows without the store columns, with a fresh index
+    """
+    times = pd.to_datetime(df["Time"], format="%Y/%m/%d %H:%M")
+    order = np.lexsort((df["Row Hash"].to_numpy(), times.to_numpy()))
+    return df.iloc[order].drop(columns=["Row Hash", "Source Row"]).reset_index(drop=True)
+
+
+def read_exports(exports):
+    """
+    Reads and deduplicates all the exports without the store
+    :return: Same rows, in the same order, as read_store after syncing the exports
+    """
+    df = pd.concat([read_reader_export(export) for export in exports], ignore_index=True)
+    return sort_rows(df.drop_duplicates(subset="Row Hash"))
+
+
+def read_store(store_dir=STORE_DIR):
+    """
+    Reads all partitions
+    :return: Deduplicated raw rows, see sort_rows for the order
+    """
+    partitions = sorted(entry for entry in os.listdir(store_dir) if entry != "manifest.json"
+                        and not entry.endswith(".tmp") and os.path.isfile(os.path.join(store_dir, entry)))
+    df = pd.concat([read_frame(os.path.join(store_dir, entry)) for entry in partitions], ignore_index=True)
+    df = sort_rows(df)
+    # Parquet brings empty text cells back as None, fillna would turn all-empty columns into float
+    for col in TEXT_COLUMNS:
+        values = df[col].to_numpy(dtype=object)
+        values[pd.isna(values)] = np.nan
+        df[col] = values
+    return df
+
+
+def rebuild_store(exports, store_dir=STORE_DIR):
+    """
+    Recreates the store from scratch, needed when an export was removed or the store version changed
+    """
+    if os.path.isdir(store_dir):
+        shutil.rmtree(store_dir)
+    for export in exports:
+        ingest_export(export, store_dir)
@@ -7,6 +7,7 @@ from .patients import patients_blueprint
 from .chatbot import chatbot_blueprint  # New chatbot endpoints
 from flask_cors import CORS
 from .transcription import transcription_blueprint
+from .model_registry import get_registry
 
 def create_app():
     app = Flask(__name__)
@@ -24,4 +25,7 @@ def create_app():
     app.register_blueprint(chatbot_blueprint)
     app.register_blueprint(transcription_blueprint)
 
+    if app.config["PRELOAD_MODELS"]:
+        get_registry().load_all()
+
     return app
\ No newline at end of file
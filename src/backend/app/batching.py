@@ -0,0 +1,123 @@
+# app/batching.py
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+
+# Requests arriving within the window are predicted together, one model call per batch
+BATCH_WINDOW_MS = float(os.getenv("PREDICTION_BATCH_WINDOW_MS", "2"))
+MAX_BATCH_SIZE = int(os.getenv("PREDICTION_MAX_BATCH_SIZE", "64"))
+
+
+class MicroBatcher:
+    def __init__(self, predict_batch, max_batch_size=MAX_BATCH_SIZE, window_ms=BATCH_WINDOW_MS, input_shape=None):
+        """
+        Groups concurrent single-example predictions into batched model calls
+        :param predict_batch: Function taking an array of shape (N, ...) and returning N results along axis 0
+        :param max_batch_size: Largest number of examples in one call
+        :param window_ms: How long the first request of a batch waits for others [milliseconds]. With 0 only the
+        requests which are already queued are batched together.
+        :param input_shape: Shape of an example, e.g. (20, 3). Examples of another shape are refused when they're
+        submitted instead of failing the whole batch.
+        """
+        self.predict_batch = predict_batch
+        self.input_shape = tuple(input_shape) if input_shape is not None else None
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.batches = 0
+        self.requests = 0
+
+    def _ensure_worker(self):
+        # The worker thread doesn't survive a fork, forked processes start their own
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, args=(self._queue,), daemon=True,
+                                                name="prediction-batcher")
+                self._pid = os.getpid()
+                self._thread.start()
+            return self._queue
+
+    def submit(self, example):
+        """
+        :param example: Single input without the batch dimension, e.g. shape (20, 3)
+        :return: Future with the model output for this example
+        """
+        future = Future()
+        try:
+            example = np.asarray(example, dtype=np.float32)
+        except (TypeError, ValueError) as e:
+            future.set_exception(Exception(f"Example isn't a numeric array: {e}"))
+            return future
+        if self.input_shape is not None and example.shape != self.input_shape:
+            future.set_exception(Exception(f"Example has shape {example.shape}, expected {self.input_shape}"))
+            return future
+        self._ensure_worker().put((example, future))
+        return future
+
+    def predict(self, example, timeout=None):
+        """
+        Blocks until the batch containing example is predicted
+        """
+        return self.submit(example).result(timeout)
+
+    def _collect(self, requests):
+        batch = [requests.get()]
+        if batch[0] is None:
+            return None
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = requests.get(timeout=remaining) if remaining > 0 else requests.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Finish the collected batch first, then stop
+                requests.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self, requests):
+        while True:
+            batch = self._collect(requests)
+            if batch is None:
+                return
+            # Examples of different shapes can't be stacked, each shape is its own model call so one malformed
+            # example only fails the requests with its shape
+            groups = {}
+            for example, future in batch:
+                groups.setdefault(example.shape, []).append((example, future))
+            for group in groups.values():
+                futures = [future for _, future in group]
+                try:
+                    outputs = self.predict_batch(np.stack([example for example, _ in group]))
+                except Exception as e:
+                    for future in futures:
+                        future.set_exception(e)
+                    continue
+                self.batches += 1
+                self.requests += len(group)
+                for future, output in zip(futures, outputs):
+                    future.set_result(output)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                self._queue.put(None)
+                self._thread.join()
+            self._thread = None
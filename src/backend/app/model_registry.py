@@ -0,0 +1,222 @@
+# app/model_registry.py
+import os
+import sys
+import threading
+import numpy as np
+
+# Repository root, holds models/, all_test_data.csv and the shared data modules
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+if REPO_ROOT not in sys.path:
+    sys.path.append(REPO_ROOT)
+
+MODELS_DIR = os.getenv("MODELS_DIR", os.path.join(REPO_ROOT, "models"))
+MODEL_EXTENSION = ".keras"
+# "numpy" runs the models with numpy_engine, "keras" with TensorFlow
+INFERENCE_ENGINE = os.getenv("INFERENCE_ENGINE", "numpy")
+# "float16" or "int8" serves the quantized artifacts written by quantization.py, numpy engine only
+MODEL_PRECISION = os.getenv("MODEL_PRECISION", "float32")
+
+
+def load_keras_model(model_path):
+    # Imported here, so importing the registry doesn't pull in TensorFlow
+    from tensorflow.keras.models import load_model
+    return load_model(model_path)
+
+
+def load_numpy_model(model_path):
+    import numpy_engine
+    # Quantized artifacts which failed the accuracy gate are refused by the engine
+    return numpy_engine.load_model(model_path, MODEL_PRECISION)
+
+
+def default_loader(model_path):
+    if INFERENCE_ENGINE == "keras":
+        if MODEL_PRECISION != "float32":
+            raise Exception(f"{MODEL_PRECISION} models are served by the numpy engine only")
+        return load_keras_model(model_path)
+    if INFERENCE_ENGINE == "numpy":
+        return load_numpy_model(model_path)
+    raise Exception(f"Inference engine {INFERENCE_ENGINE} not recognized, use numpy or keras")
+
+
+def artifact_mtime(model_path):
+    """
+    :return: Latest st_mtime_ns of a model and the artifacts served in its place, the .npz export and the
+    quantized artifact of MODEL_PRECISION, so replacing any of them reloads the model
+    """
+    import numpy_engine
+    paths = [model_path, os.path.splitext(model_path)[0] + ".npz"]
+    if MODEL_PRECISION != "float32":
+        paths.append(numpy_engine.quantized_model_path(model_path, MODEL_PRECISION))
+    # Raises FileNotFoundError when the model itself is missing
+    mtime = os.stat(model_path).st_mtime_ns
+    for path in paths[1:]:
+        try:
+            mtime = max(mtime, os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            pass
+    return mtime
+
+
+def warm_up(model):
+    """
+    Runs one prediction on zeros, so the predict function is traced before the first request
+    """
+    input_shape = [dim or 1 for dim in model.input_shape[1:]]
+    model.predict_on_batch(np.zeros([1] + input_shape, dtype=np.float32))
+
+
+class LoadedModel:
+    def __init__(self, name, path, mtime, model):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.model = model
+
+    def predict(self, inputs):
+        """
+        :param inputs: Array of shape (batch, ...) matching the model input
+        :return: Model output as numpy array
+        """
+        # predict_on_batch reuses the function traced during warm-up, predict() sets up a new data pipeline
+        # on every call which costs more than the inference itself for a few examples
+        return np.asarray(self.model.predict_on_batch(np.asarray(inputs, dtype=np.float32)))
+
+
+class ModelGroup:
+    def __init__(self, members, fused=None):
+        """
+        Models evaluated on the same inputs, e.g. the horizons of a forecast
+        :param members: LoadedModels of the group
+        :param fused: Optional single model computing all the members' outputs at once
+        """
+        self.members = members
+        self.fused = fused
+
+    def predict(self, inputs):
+        """
+        :return: Array of shape (batch, members), one prediction of every member per example
+        """
+        inputs = np.asarray(inputs, dtype=np.float32)
+        if self.fused is not None:
+            return np.asarray(self.fused.predict_on_batch(inputs)).reshape(len(inputs), -1)
+        return np.concatenate([member.predict(inputs).reshape(len(inputs), -1) for member in self.members], axis=1)
+
+
+def fuse_group(models):
+    """
+    :return: Fused model for numpy engine models, None when they can't be fused (e.g. keras models)
+    """
+    import numpy_engine
+    if not all(isinstance(model, numpy_engine.NumpyModel) for model in models):
+        return None
+    return numpy_engine.fuse_models(models)
+
+
+class ModelRegistry:
+    def __init__(self, models_dir=MODELS_DIR, loader=default_loader, hot_reload=True):
+        """
+        Loads every model once and hands out the same instance to all callers
+        :param models_dir: Directory with the .keras models
+        :param loader: Function loading a model from its path
+        :param hot_reload: Reload a model when its file or an artifact served in its place is modified
+        """
+        self.models_dir = models_dir
+        self.loader = loader
+        self.hot_reload = hot_reload
+        self._models = {}
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._groups = {}
+
+    def names(self):
+        """
+        :return: Names of the models available in models_dir, without the extension
+        """
+        return sorted(file[:-len(MODEL_EXTENSION)] for file in os.listdir(self.models_dir)
+                      if file.endswith(MODEL_EXTENSION))
+
+    def path(self, name):
+        return os.path.join(self.models_dir, name + MODEL_EXTENSION)
+
+    def get(self, name):
+        """
+        :param name: Model name, e.g. "lstm_2h_Glucose_Rapid Insulin IOB_Carbohydrates"
+        :return: Warmed up LoadedModel, shared between threads
+        """
+        loaded = self._models.get(name)
+        if loaded is not None and not self.hot_reload:
+            return loaded
+
+        path = self.path(name)
+        try:
+            mtime = artifact_mtime(path)
+        except FileNotFoundError:
+            if loaded is not None:
+                # Keep serving the last version while the file is being replaced
+                return loaded
+            raise Exception(f"Model {name} not found in {self.models_dir}")
+        if loaded is not None and loaded.mtime == mtime:
+            return loaded
+
+        with self._lock:
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        # Only one thread loads a model, the others wait and use its result
+        with load_lock:
+            loaded = self._models.get(name)
+            if loaded is None or loaded.mtime != mtime:
+                model = self.loader(path)
+                warm_up(model)
+                # Requests already holding the old model finish with it
+                loaded = LoadedModel(name, path, mtime, model)
+                self._models[name] = loaded
+            return loaded
+
+    def get_group(self, names):
+        """
+        :param names: Model names with the same input, e.g. the 30min, 1h and 2h models
+        :return: ModelGroup, rebuilt only when one of its models was reloaded
+        """
+        members = [self.get(name) for name in names]
+        key = tuple(names)
+        group = self._groups.get(key)
+        if group is None or any(old is not new for old, new in zip(group.members, members)):
+            group = ModelGroup(members, fuse_group([member.model for member in members]))
+            self._groups[key] = group
+        return group
+
+    def load_all(self):
+        """
+        Loads and warms up every model in models_dir, e.g. when a worker process starts
+        """
+        for name in self.names():
+            self.get(name)
+
+    def loaded(self):
+        return {name: loaded.mtime for name, loaded in self._models.items()}
+
+    def unload(self, name=None):
+        with self._lock:
+            if name is None:
+                self._models.clear()
+            else:
+                self._models.pop(name, None)
+            self._groups.clear()
+
+
+_registry = None
+_registry_pid = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    :return: Registry of the current process. Forked workers (gunicorn, celery) create their own, TensorFlow
+    state doesn't survive a fork.
+    """
+    global _registry, _registry_pid
+    with _registry_lock:
+        if _registry is None or _registry_pid != os.getpid():
+            _registry = ModelRegistry()
+            _registry_pid = os.getpid()
+        return _registry
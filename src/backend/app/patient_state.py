@@ -0,0 +1,290 @@
+# app/patient_state.py
+import os
+import json
+import threading
+import numpy as np
+import pandas as pd
+
+# Importing the registry puts the repository root on sys.path
+from app.model_registry import REPO_ROOT
+
+from insulin import InsulinProfile, insulin_kernels, get_profile
+
+# Written by FeaturePipeline.save_scaler, the min-max scaling the models were trained with
+SCALER_PATH = os.getenv("SCALER_PATH", os.path.join(REPO_ROOT, "models", "scaler.json"))
+# Inputs of the served models, in order
+MODEL_FEATURES = ["Glucose", "Rapid Insulin IOB", "Carbohydrates"]
+MMOL_TO_MGDL = 18.016
+
+
+class FeatureScaler:
+    def __init__(self, data_min, data_max):
+        """
+        Min-max scaling of the model features, same as the MinMaxScaler fitted by my_functions.min_max_normalize
+        :param data_min: Minimum of every feature in the training data
+        :param data_max: Maximum of every feature in the training data
+        """
+        self.data_min = np.asarray(data_min, dtype=np.float64)
+        self.data_range = np.asarray(data_max, dtype=np.float64) - self.data_min
+        # Constant features are scaled by 1, like sklearn does
+        self.data_range[self.data_range == 0] = 1
+
+    def transform(self, values):
+        return (np.asarray(values, dtype=np.float64) - self.data_min) / self.data_range
+
+    def inverse_transform(self, values, feature=0):
+        return np.asarray(values) * self.data_range[feature] + self.data_min[feature]
+
+
+def load_scaler_params(path=SCALER_PATH):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def feature_scaler(params, features=MODEL_FEATURES):
+    missing = [feature for feature in features if feature not in params["features"]]
+    if missing:
+        raise Exception(f"Scaler parameters have no {missing}")
+    return FeatureScaler([params["features"][feature]["min"] for feature in features],
+                         [params["features"][feature]["max"] for feature in features])
+
+
+def denormalize_glucose(scaler, values, unit_to="mgdl"):
+    """
+    :param scaler: FeatureScaler of the model features, Glucose first
+    :param values: Normalized glucose, e.g. model predictions
+    :param unit_to: "mgdl" or "mmol"
+    """
+    glucose = scaler.inverse_transform(values, 0)
+    return glucose * MMOL_TO_MGDL if unit_to == "mgdl" else glucose
+
+
+class PatientState:
+    def __init__(self, scaler, input_width=20, sampl_freq=15, insulin_profile="fiasp"):
+        """
+        Online model inputs of one patient. Readings and doses are binned into sampl_freq minute samples like
+        my_functions.resample_data: glucose is the mean of the readings, insulin and carbohydrates are summed.
+        Every update costs O(1), only the samples in the window and the pending insulin effects are kept.
+        :param scaler: FeatureScaler of MODEL_FEATURES
+        :param input_width: Number of samples in the model input window
+        :param sampl_freq: Sampling period [minutes]
+        :param insulin_profile: Insulin profile name or InsulinProfile, as used for training
+        """
+        self.scaler = scaler
+        self.input_width = input_width
+        self.sampl_freq = sampl_freq
+        profile = get_profile(insulin_profile)
+        self.iob_kernel, _ = insulin_kernels(profile.td, profile.tp, sampl_freq)
+
+        # Every row is written twice, at i and i + input_width, so the last input_width rows are always one
+        # contiguous slice of the buffer. Rows which were never written stay NaN, so they can't pass as samples.
+        self._buffer = np.full((2 * input_width, len(MODEL_FEATURES)), np.nan, dtype=np.float32)
+        # IOB of the current and the upcoming samples, the effect of every dose is added when it's injected
+        self._iob_future = np.zeros(len(self.iob_kernel))
+        self.sample = None
+        # Samples since the first glucose reading, earlier ones have no glucose to carry and don't count
+        self.samples_seen = 0
+
+        self._glucose_sum = 0.0
+        self._glucose_count = 0
+        self._carbs = 0.0
+        self.carbs_total = 0.0
+        # Last sample with a glucose reading and its value, for interpolating gaps
+        self._last_glucose_sample = None
+        self._last_glucose = np.nan
+
+    def _sample_index(self, time):
+        return int(pd.Timestamp(time).value // (self.sampl_freq * 60 * 10**9))
+
+    def _write_row(self, sample, glucose, iob, carbs):
+        row = self.scaler.transform([glucose, iob, carbs])
+        position = sample % self.input_width
+        self._buffer[position] = row
+        self._buffer[position + self.input_width] = row
+
+    def _write_current(self):
+        if self._glucose_count:
+            glucose = self._glucose_sum / self._glucose_count
+        else:
+            # No reading yet in this sample, carry the last one until it arrives
+            glucose = self._last_glucose
+        self._write_row(self.sample, glucose, self._iob_future[self.sample % len(self._iob_future)], self._carbs)
+
+    def _advance(self, time):
+        sample = self._sample_index(time)
+        if self.sample is None:
+            self.sample = sample
+            return
+        if sample < self.sample:
+            raise Exception("Readings must arrive in time order, got one for an earlier sample")
+        if sample == self.sample:
+            return
+
+        kernel_len = len(self._iob_future)
+        previous = self.sample
+        self.sample = sample
+        if self._last_glucose_sample is not None:
+            self.samples_seen += sample - previous
+        self._glucose_sum = 0.0
+        self._glucose_count = 0
+        self._carbs = 0.0
+        # Empty samples since the previous one, only those still in the window are written. Their glucose is
+        # carried forward and interpolated once the next reading arrives.
+        for empty in range(max(previous + 1, sample - self.input_width + 1), sample):
+            # All the doses were injected up to the previous sample, their effect lasts kernel_len samples
+            iob = self._iob_future[empty % kernel_len] if empty - previous < kernel_len else 0.0
+            self._write_row(empty, self._last_glucose, iob, 0.0)
+        # Free the IOB slots of the closed samples for the upcoming ones, after a gap longer than the insulin
+        # duration no dose has any effect left
+        if sample - previous >= kernel_len:
+            self._iob_future[:] = 0.0
+        else:
+            for closed in range(previous, sample):
+                self._iob_future[closed % kernel_len] = 0.0
+
+    def add_glucose(self, time, value, unit="mmol"):
+        """
+        :param time: Time of the reading
+        :param value: Glucose reading
+        :param unit: "mmol" or "mgdl", the models use mmol/L
+        """
+        self._advance(time)
+        if self._last_glucose_sample is None:
+            self.samples_seen = 1
+        if unit == "mgdl":
+            value = value / MMOL_TO_MGDL
+        self._glucose_sum += value
+        self._glucose_count += 1
+        self._interpolate_gap(value)
+        self._last_glucose_sample = self.sample
+        self._last_glucose = self._glucose_sum / self._glucose_count
+        self._write_current()
+
+    def _interpolate_gap(self, value):
+        # Linear interpolation over the samples without a reading, like interpolate_gaps does for training
+        last = self._last_glucose_sample
+        if last is None or self.sample - last < 2:
+            return
+        first = max(last + 1, self.sample - self.input_width + 1)
+        for empty in range(first, self.sample):
+            glucose = self._last_glucose + (value - self._last_glucose) * (empty - last) / (self.sample - last)
+            position = empty % self.input_width
+            scaled = (glucose - self.scaler.data_min[0]) / self.scaler.data_range[0]
+            self._buffer[position, 0] = scaled
+            self._buffer[position + self.input_width, 0] = scaled
+
+    def add_insulin(self, time, units):
+        """
+        :param time: Time of the rapid insulin dose
+        :param units: Insulin units
+        """
+        self._advance(time)
+        kernel_len = len(self._iob_future)
+        # Same as insulin.insulin_on_board_series, but only adds this dose's curve
+        positions = (self.sample + np.arange(kernel_len)) % kernel_len
+        self._iob_future[positions] += units * self.iob_kernel
+        self._write_current()
+
+    def add_carbs(self, time, grams):
+        """
+        :param time: Time of the meal
+        :param grams: Carbohydrates [g]
+        """
+        self._advance(time)
+        self._carbs += grams
+        self.carbs_total += grams
+        self._write_current()
+
+    def add_reading(self, reading):
+        """
+        :param reading: Dictionary with "time" and any of "glucose" (mmol/L), "glucose_mgdl", "insulin" and "carbs"
+        """
+        time = reading["time"]
+        if reading.get("insulin"):
+            self.add_insulin(time, float(reading["insulin"]))
+        if reading.get("carbs"):
+            self.add_carbs(time, float(reading["carbs"]))
+        if reading.get("glucose") is not None:
+            self.add_glucose(time, float(reading["glucose"]))
+        elif reading.get("glucose_mgdl") is not None:
+            self.add_glucose(time, float(reading["glucose_mgdl"]), unit="mgdl")
+        if self.sample is None:
+            self._advance(time)
+
+    @property
+    def ready(self):
+        """
+        Whether the window is filled with samples and has a glucose value
+        """
+        return self.samples_seen >= self.input_width and not np.isnan(self.window()).any()
+
+    def window(self):
+        """
+        :return: Normalized model input of shape (input_width, features), a view of the ring buffer
+        """
+        start = (self.sample + 1) % self.input_width if self.sample is not None else 0
+        return self._buffer[start:start + self.input_width]
+
+    def denormalize_glucose(self, values, unit_to="mgdl"):
+        return denormalize_glucose(self.scaler, values, unit_to)
+
+
+class PatientStates:
+    def __init__(self, scaler_params=None):
+        """
+        In-memory states of all the patients served by this process
+        """
+        self._scaler_params = scaler_params
+        self._scaler = None
+        self._state_kwargs = None
+        self._states = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _new_state(self):
+        if self._scaler is None:
+            params = self._scaler_params or load_scaler_params()
+            self._scaler = feature_scaler(params)
+            # Same resampling and insulin curve as the training features
+            self._state_kwargs = {"sampl_freq": params.get("sampl_freq", 15)}
+            if "insulin_profile" in params:
+                self._state_kwargs["insulin_profile"] = InsulinProfile(**params["insulin_profile"])
+        return PatientState(self._scaler, **self._state_kwargs)
+
+    def get(self, patient_id):
+        """
+        :return: Tuple of the patient's state and the lock to hold while updating or reading it
+        """
+        with self._lock:
+            if patient_id not in self._states:
+                self._states[patient_id] = self._new_state()
+                self._locks[patient_id] = threading.Lock()
+            return self._states[patient_id], self._locks[patient_id]
+
+    def update(self, patient_id, readings):
+        """
+        :param readings: List of reading dictionaries (see PatientState.add_reading), in time order
+        :return: Copy of the patient's current window and whether it's ready
+        """
+        state, lock = self.get(patient_id)
+        with lock:
+            for reading in readings:
+                state.add_reading(reading)
+            return state.window().copy(), state.ready
+
+    def drop(self, patient_id):
+        with self._lock:
+            self._states.pop(patient_id, None)
+            self._locks.pop(patient_id, None)
+
+
+_patient_states = None
+_patient_states_lock = threading.Lock()
+
+
+def get_patient_states():
+    global _patient_states
+    with _patient_states_lock:
+        if _patient_states is None:
+            _patient_states = PatientStates()
+        return _patient_states
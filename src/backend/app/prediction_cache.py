@@ -0,0 +1,155 @@
+# app/prediction_cache.py
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Clients poll with the same window until the next 15 minute sample arrives, so that's the default lifetime
+PREDICTION_CACHE_TTL = float(os.getenv("PREDICTION_CACHE_TTL", "900"))
+PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", "4096"))
+# Shared tier for all worker processes, off unless PREDICTION_CACHE_SHARED=1
+PREDICTION_CACHE_SHARED = os.getenv("PREDICTION_CACHE_SHARED", "0") == "1"
+PREDICTION_CACHE_REDIS_URL = os.getenv("PREDICTION_CACHE_REDIS_URL",
+                                       os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0"))
+REDIS_KEY_PREFIX = "prediction:"
+
+
+def window_key(window, model_id, horizon):
+    """
+    :param window: Normalized model input, e.g. of shape (1, 20, 3)
+    :param model_id: Identifies the model version, e.g. name and file modification time
+    :param horizon: Prediction horizon, or any other name of what is predicted
+    :return: Hex digest identifying the prediction
+    """
+    window = np.ascontiguousarray(window, dtype=np.float32)
+    digest = hashlib.sha1()
+    digest.update(repr((window.shape, str(model_id), str(horizon))).encode())
+    digest.update(window.tobytes())
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    def __init__(self, max_size=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL, redis_url=None):
+        """
+        LRU cache of JSON serializable predictions with a time to live
+        :param max_size: Largest number of predictions kept in the process
+        :param ttl: Seconds a prediction stays valid
+        :param redis_url: Optional Redis shared by all the processes, checked after the in-process tier
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.redis_url = redis_url
+        self._redis = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.shared_errors = 0
+
+    def _shared(self):
+        if self.redis_url and self._redis is None:
+            import redis
+            self._redis = redis.Redis.from_url(self.redis_url, socket_timeout=0.05)
+        return self._redis
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _set_local(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        """
+        :return: Cached value or None
+        """
+        value = self._get_local(key)
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+            return value
+        if self.redis_url:
+            try:
+                stored = self._shared().get(REDIS_KEY_PREFIX + key)
+            except Exception:
+                # The cache must never fail a prediction, Redis being down is a miss
+                stored = None
+                with self._lock:
+                    self.shared_errors += 1
+            if stored is not None:
+                value = json.loads(stored)
+                self._set_local(key, value)
+                with self._lock:
+                    self.shared_hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self._set_local(key, value)
+        if self.redis_url:
+            try:
+                self._shared().setex(REDIS_KEY_PREFIX + key, max(1, int(self.ttl)), json.dumps(value))
+            except Exception:
+                with self._lock:
+                    self.shared_errors += 1
+
+    def get_or_compute(self, key, compute):
+        """
+        :param compute: Function returning the value on a miss
+        :return: Tuple of the value and whether it came from the cache
+        """
+        value = self.get(key)
+        if value is not None:
+            return value, True
+        value = compute()
+        self.set(key, value)
+        return value, False
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+                "shared_errors": self.shared_errors,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "shared": bool(self.redis_url),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_prediction_cache = None
+_prediction_cache_lock = threading.Lock()
+
+
+def get_prediction_cache():
+    global _prediction_cache
+    with _prediction_cache_lock:
+        if _prediction_cache is None:
+            _prediction_cache = PredictionCache(redis_url=PREDICTION_CACHE_REDIS_URL if PREDICTION_CACHE_SHARED else None)
+        return _prediction_cache
@@ -1,62 +1,166 @@
 import numpy as np
-import tensorflow as tf
-from tensorflow.keras.models import load_model
 import os
 os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
-import tensorflow as tf
+import functools
+import threading
 import pandas as pd
 import random
 
+# Importing the registry puts the repository root on sys.path
+from app.model_registry import REPO_ROOT, get_registry
+from app.batching import MicroBatcher
+from app.prediction_cache import get_prediction_cache, window_key
+from app.patient_state import denormalize_glucose, feature_scaler, load_scaler_params
+
+from windowing import examples_from_frame, HORIZONS
+
+DEFAULT_MODEL = "lstm_2h_Glucose_Rapid Insulin IOB_Carbohydrates"
+# Models of the forecast trajectory, all with the same (20, 3) input
+HORIZON_MODELS = {horizon: f"lstm_{horizon}_Glucose_Rapid Insulin IOB_Carbohydrates" for horizon in HORIZONS}
+SAMPL_FREQ = 15
+
+
+@functools.lru_cache(maxsize=None)
+def load_test_examples(path):
+    """
+    Reads the exported test examples once per process
+    :return: Tuple of example ids and the (examples, 20, 3) array
+    """
+    return examples_from_frame(pd.read_csv(path), width=20)
+
+
 class GlucosePredictor:
-    def __init__(self):
+    def __init__(self, model_name=DEFAULT_MODEL, registry=None, batching=True, cache=True, scaler=None):
         """
-        Initializes the Glucose Predictor by loading the trained LSTM model.
+        Initializes the Glucose Predictor with a trained LSTM model from the model registry.
+        :param batching: Predict concurrent requests together in one model call, see app.batching
+        :param cache: Reuse predictions of identical input windows, see app.prediction_cache
+        :param scaler: FeatureScaler the inputs were normalized with, defaults to the one of app.patient_state
         """
-        self.base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Move out of src/
-        self.model_path = os.path.join(self.base_dir, "models", "lstm_2h_Glucose_Rapid Insulin IOB_Carbohydrates.keras")
-        self.model = load_model(self.model_path)  # Load the LSTM model
-        self.test = pd.read_csv("all_test_data.csv")
+        self.base_dir = REPO_ROOT
+        self.model_name = model_name
+        self.registry = registry or get_registry()
+        self.model_path = self.registry.path(model_name)
+        # Predictions are converted back with the same min-max scaling the input windows were normalized with
+        self.scaler = scaler or feature_scaler(load_scaler_params())
+        # All test examples as one (examples, 20, 3) array
+        self.example_ids, self.examples = load_test_examples(os.path.join(self.base_dir, "all_test_data.csv"))
+        self.batcher = MicroBatcher(lambda batch: self.model.predict(batch), input_shape=self.examples.shape[1:]) \
+            if batching else None
+        self.cache = get_prediction_cache() if cache else None
+
+    def _cached(self, inputs, model_ids, horizon, compute):
+        """
+        :return: compute() result, or the cached one for the same window, model versions and horizon, with a
+        "cached" flag added
+        """
+        if self.cache is None:
+            return dict(compute(), cached=False)
+        result, hit = self.cache.get_or_compute(window_key(inputs, model_ids, horizon), compute)
+        return dict(result, cached=hit)
+
+    @property
+    def model(self):
+        # Looked up on every use, so a modified model file is picked up
+        return self.registry.get(self.model_name)
 
     def predict_next_2h(self, input_data):
         """
         Predicts glucose levels 2 hours ahead based on input data.
 
-        :param input_data: List of past glucose readings.
+        :param input_data: Normalized input window, e.g. from app.patient_state, see prepare_inputs.
         :return: Predicted glucose level.
         """
-        MMOL_TO_MGDL = 18.016
-        reshaped_data = {}
-        def bg_denormalize(norm_val, unit_to="mgdl"):
-            orig = norm_val * 23.979
-            if unit_to == "mgdl":
-                orig *= MMOL_TO_MGDL
-            return orig
-
-
-        random_number = random.randint(0, 10)
-        # Extract data for each Example_ID and reshape
-        for example_id in self.test["Example_ID"].unique():
-            example_data = self.test[self.test["Example_ID"] == example_id].drop(columns=["Example_ID"]).values  # Remove ID column
-            reshaped_data[example_id] = example_data.reshape(1, 20, 3)  # Reshape to (1, 20, 3)
-
-        inputs = reshaped_data[random_number]  # Select Example_ID = 1
-        lstm_predictions = self.model.predict(inputs)
-        converted_pred = bg_denormalize(lstm_predictions)[0][0]
-
-        def generate_action_suggestion(self, predicted_value):
-            """
-            Provides action recommendations based on glucose levels
-            Source for info: https://www.mayoclinic.org/diseases-conditions/hyperglycemia/symptoms-causes/syc-20373631
-            
-            """
-            if predicted_value < 70:
-                return "Low glucose detected! Consider having a small snack with carbohydrates."
-            elif 70 <= predicted_value <= 180:
-                return "Glucose level is stable. Maintain normal dietary and exercise routines."
-            else:
-                return "High glucose alert! Consider insulin intake or consulting a doctor."
-
-        action = generate_action_suggestion(converted_pred)
+        inputs = self.prepare_inputs(input_data)  # Shape (1, 20, 3)
+        model = self.model
+        return self._cached(inputs, [(model.name, model.mtime)], "2h", lambda: self._predict_next_2h(inputs))
+
+    def _predict_next_2h(self, inputs):
+        if self.batcher is not None:
+            # Batched with the other requests in flight, result of shape (1,) extended back to (1, 1)
+            lstm_predictions = self.batcher.predict(inputs[0])[np.newaxis]
+        else:
+            lstm_predictions = self.model.predict(inputs)
+        converted_pred = denormalize_glucose(self.scaler, lstm_predictions)[0][0]
+
+        action = self.generate_action_suggestion(converted_pred)
         return {"predicted_glucose": float(converted_pred), "action": action}
 
-    
\ No newline at end of file
+    def validate_window(self, window):
+        """
+        :param window: Normalized input window, e.g. a request's list of rows
+        :return: Window as float32 array of shape (20, 3)
+        """
+        try:
+            inputs = np.asarray(window, dtype=np.float32)
+        except (TypeError, ValueError):
+            raise Exception("Window must be a list of numeric rows")
+        if inputs.shape != self.examples.shape[1:]:
+            raise Exception(f"Window must have shape {self.examples.shape[1:]}, got {inputs.shape}")
+        if not np.isfinite(inputs).all():
+            raise Exception("Window has missing or infinite values")
+        return inputs
+
+    def prepare_inputs(self, input_data=None):
+        """
+        :param input_data: Normalized input window of shape (20, 3), like the rows of all_test_data.csv or
+        PatientState.window(), see validate_window. Without one a random test example is used.
+        :return: Array of shape (1, 20, 3)
+        """
+        if input_data is not None:
+            return self.validate_window(input_data)[np.newaxis]
+        return self.examples[random.randrange(len(self.examples))][np.newaxis]
+
+    def predict_horizons(self, input_data=None, horizons=HORIZON_MODELS):
+        """
+        Predicts glucose at all the horizons from one input window, the horizon models run fused in a single pass
+        :param input_data: See prepare_inputs
+        :param horizons: Dictionary of horizon name and model name
+        :return: Forecast trajectory, ordered by time ahead
+        """
+        inputs = self.prepare_inputs(input_data)
+        names = sorted(horizons, key=lambda horizon: HORIZONS[horizon])
+        group = self.registry.get_group([horizons[name] for name in names])
+        model_ids = [(member.name, member.mtime) for member in group.members]
+        return self._cached(inputs, model_ids, ",".join(names), lambda: self._predict_horizons(inputs, names, group))
+
+    def _predict_horizons(self, inputs, names, group):
+        predictions = denormalize_glucose(self.scaler, group.predict(inputs))[0]
+
+        trajectory = [{
+            "horizon": name,
+            "minutes_ahead": HORIZONS[name] * SAMPL_FREQ,
+            "predicted_glucose": float(prediction),
+        } for name, prediction in zip(names, predictions)]
+        # Act on the furthest prediction, like predict_next_2h
+        return {"trajectory": trajectory, "action": self.generate_action_suggestion(trajectory[-1]["predicted_glucose"])}
+
+    def generate_action_suggestion(self, predicted_value):
+        """
+        Provides action recommendations based on glucose levels
+        Source for info: https://www.mayoclinic.org/diseases-conditions/hyperglycemia/symptoms-causes/syc-20373631
+
+        """
+        if predicted_value < 70:
+            return "Low glucose detected! Consider having a small snack with carbohydrates."
+        elif 70 <= predicted_value <= 180:
+            return "Glucose level is stable. Maintain normal dietary and exercise routines."
+        else:
+            return "High glucose alert! Consider insulin intake or consulting a doctor."
+
+
+_predictors = {}
+_predictors_lock = threading.Lock()
+
+
+def get_predictor(model_name=DEFAULT_MODEL):
+    """
+    :return: GlucosePredictor shared by all requests of the process
+    """
+    registry = get_registry()
+    with _predictors_lock:
+        predictor = _predictors.get(model_name)
+        if predictor is None or predictor.registry is not registry:
+            predictor = GlucosePredictor(model_name, registry)
+            _predictors[model_name] = predictor
+        return predictor
@@ -9,7 +9,9 @@ from .firebase_client import db, bucket  # Use shared Firebase resources
 from .transcription import transcription, action_items
 
 from app.tasks import generate_tts_notification
-from app.predictive_analytics import GlucosePredictor
+from app.predictive_analytics import get_predictor
+from app.patient_state import get_patient_states
+from app.prediction_cache import get_prediction_cache
 from app.tasks import send_glucose_notification
 
 # Create a blueprint for our routes
@@ -158,27 +160,70 @@ def predict_glucose():
     """
     Endpoint to predict glucose levels 2 hours ahead based on past glucose readings.
     Expects a JSON payload with a 'readings' key containing a list of glucose readings and optional firebase
-    token.
+    token. With a 'patient_id', readings are {"time", "glucose", "insulin", "carbs"} objects added to the
+    patient's online features, the prediction uses the patient's last 20 samples. Until the patient has 20
+    samples since their first glucose reading the response is 202 with "ready": false and no prediction.
     """
     data = request.get_json()
     readings = data.get('readings', [])
+    patient_id = data.get('patient_id')
     firebase_token = data.get("firebase_token") # For Push Notification
 
     if not readings:
         return jsonify({"error": "No glucose readings provided."}), 400
 
-    predictor = GlucosePredictor()
-    prediction = predictor.predict_next_2h(readings)
-    action = predictor.generate_action_suggestion(prediction)
+    window = None
+    if patient_id:
+        try:
+            window, ready = get_patient_states().update(patient_id, readings)
+        except Exception as e:
+            return jsonify({"error": f"Invalid readings: {e}"}), 400
+        if not ready:
+            # Never predict a patient's glucose from anything but their own window
+            return jsonify({"ready": False, "patient_id": patient_id,
+                            "message": "Not enough readings yet for a prediction."}), 202
+
+    # Shared predictor, the model is loaded and warmed up once per worker process
+    predictor = get_predictor()
+    prediction = predictor.predict_next_2h(window)
+
+    if not firebase_token:
+        return jsonify(prediction), 200
+
+    # Send a notification with the prediction and action suggestion.
+    task = send_glucose_notification.delay(firebase_token, prediction["predicted_glucose"], prediction["action"])
 
     def generate_audio():
         for chunk in task.get():
             yield chunk
 
-    if firebase_token:
-        task = send_glucose_notification.delay(prediction, action)
-
-        # Send a notification with the prediction and action suggestion.
-        task = send_glucose_notification.delay(firebase_token, prediction["predicted_glucose"], prediction["action"])
-    
     return Response(stream_with_context(generate_audio()), content_type="audio/mpeg")
+
+
+@main_blueprint.route('/predict_glucose/trajectory', methods=['POST'])
+def predict_glucose_trajectory():
+    """
+    Endpoint to predict glucose 30 minutes, 1 hour and 2 hours ahead in one call.
+    Expects a JSON payload with an optional 'window' key containing 20 normalized
+    [glucose, insulin on board, carbohydrates] rows. Without a window a random test example is used.
+    """
+    data = request.get_json(silent=True) or {}
+    window = data.get('window')
+
+    predictor = get_predictor()
+    if window is not None:
+        try:
+            window = predictor.validate_window(window)
+        except Exception as e:
+            return jsonify({"error": f"Invalid window: {e}"}), 400
+
+    prediction = predictor.predict_horizons(window)
+    return jsonify(prediction), 200
+
+
+@main_blueprint.route('/predict_glucose/cache', methods=['GET'])
+def prediction_cache_stats():
+    """
+    Endpoint reporting the prediction cache hit and miss counters of this worker process.
+    """
+    return jsonify(get_prediction_cache().stats()), 200
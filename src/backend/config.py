@@ -8,4 +8,7 @@ class Config:
     # URL for the Celery broker (Redis in this case)
     CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
 
+    # Load and warm up every model in models/ when the app starts, instead of on the first prediction
+    PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "0") == "1"
+
     # Additional configuration variables can be added here.
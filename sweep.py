@@ -0,0 +1,195 @@
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from windowing import build_windows, HORIZONS
+from evaluation import evaluate_predictions, denormalize_glucose, parse_model_name
+from backtest import FOLD_MODELS
+import numpy_engine
+
+# Compares feature subsets and horizons in one run. The normalized splits are prepared once, every worker gets them
+# as one base array per split and builds the windows of a subset from it, memoized, so no combination prepares the
+# features again. Models are fitted on the train split (see backtest.FOLD_MODELS) and scored on the test split,
+# the saved models in models/ with a matching name are scored as they are:
+#   python sweep.py --subsets "Glucose,Rapid Insulin IOB,Carbohydrates" "Glucose,Rapid Insulin IOB,Carbohydrates,calories"
+#       --horizons 30min 1h 2h --models persistence linear saved --output sweep.csv
+
+INPUT_WIDTH = 20
+DEFAULT_SUBSETS = [
+    ["Glucose"],
+    ["Glucose", "Rapid Insulin IOB", "Carbohydrates"],
+    ["Glucose", "Rapid Insulin IOB", "Carbohydrates", "calories"],
+    ["Glucose", "Rapid Insulin IOB", "Carbohydrates", "Hour", "Long Insulin"],
+]
+
+# Set in every worker process by _init_worker
+_base = None
+_subsets = {}
+_windows = {}
+
+
+def base_arrays(pipeline):
+    """
+    :return: Dictionary with the feature names and, per split, the normalized features (time, features) as one
+    float32 array and the sample times
+    """
+    train_df, val_df, test_df, _ = pipeline.normalize()
+    features = [col for col in train_df.columns if col != "Time"]
+    base = {"features": features}
+    for split, split_df in [("train", train_df), ("val", val_df), ("test", test_df)]:
+        base[split] = (np.ascontiguousarray(split_df[features].to_numpy(dtype=np.float32)),
+                       split_df["Time"].to_numpy())
+    return base
+
+
+def _init_worker(base, threads=None):
+    global _base
+    _base = base
+    _subsets.clear()
+    _windows.clear()
+    if threads:
+        os.environ["TF_NUM_INTRAOP_THREADS"] = str(threads)
+        os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+
+
+def subset_windows(split, columns, horizon, input_width=INPUT_WIDTH):
+    """
+    Valid windows of a feature subset, memoized per process. The subset columns are taken from the base array once
+    and shared by all the horizons.
+    :return: Tuple of inputs (N, input_width, features) and normalized glucose labels (N,)
+    """
+    key = (split, tuple(columns), horizon, input_width)
+    if key not in _windows:
+        values, times = _base[split]
+        subset_key = (split, tuple(columns))
+        if subset_key not in _subsets:
+            _subsets[subset_key] = np.ascontiguousarray(values[:, [_base["features"].index(col) for col in columns]])
+        inputs, labels, mask = build_windows(_subsets[subset_key], input_width, HORIZONS[horizon],
+                                             label_column=columns.index("Glucose"), times=times)
+        _windows[key] = (np.ascontiguousarray(inputs[mask]), np.asarray(labels[mask]))
+    return _windows[key]
+
+
+def _run_combination(job):
+    """
+    :param job: Tuple of columns, horizon, model (name of FOLD_MODELS or path of a saved model), glucose
+    denormalization (scaler, glucose index) and model params
+    :return: Dictionary of the combination and its evaluation results on the test split
+    """
+    columns, horizon, model, denormalize, params = job
+    start = time.perf_counter()
+    test_inputs, test_labels = subset_windows("test", columns, horizon)
+    if model in FOLD_MODELS:
+        predictions = FOLD_MODELS[model](subset_windows("train", columns, horizon),
+                                         subset_windows("val", columns, horizon), test_inputs, params)
+        name = model
+    else:
+        predictions = numpy_engine.load_model(model).predict(test_inputs)
+        name = f"saved {parse_model_name(os.path.splitext(os.path.basename(model))[0])[0]}"
+
+    scaler, glucose_index = denormalize
+    results = evaluate_predictions(denormalize_glucose(test_labels, scaler, glucose_index),
+                                   denormalize_glucose(np.ravel(predictions), scaler, glucose_index))
+    return {
+        "features": "_".join(columns),
+        "n_features": len(columns),
+        "horizon": horizon,
+        "model": name,
+        "test_windows": len(test_labels),
+        **results,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def saved_models(columns, horizon, models_dir="models", input_width=INPUT_WIDTH):
+    """
+    :return: Paths of the saved models of this feature subset and horizon. Models taking other inputs than
+    (input_width, features) windows, like the FFNN with per-feature widths, are left out.
+    """
+    paths = []
+    for file in sorted(os.listdir(models_dir)) if os.path.isdir(models_dir) else []:
+        if not file.endswith(".keras"):
+            continue
+        _, model_horizon, model_columns = parse_model_name(os.path.splitext(file)[0])
+        if model_horizon != horizon or model_columns != list(columns):
+            continue
+        _, _, input_shape = numpy_engine.read_keras_model(os.path.join(models_dir, file))
+        if list(input_shape[1:]) == [input_width, len(columns)]:
+            paths.append(os.path.join(models_dir, file))
+    return paths
+
+
+def sweep(subsets=DEFAULT_SUBSETS, horizons=tuple(HORIZONS), models=("persistence", "linear"), workers=None,
+          pipeline=None, params=None, models_dir="models"):
+    """
+    :param subsets: Feature subsets, every one must contain Glucose
+    :param horizons: Prediction horizons, see windowing.HORIZONS
+    :param models: Names of backtest.FOLD_MODELS, and "saved" for the models in models_dir
+    :param workers: Number of processes, defaults to the number of cores
+    :param pipeline: FeaturePipeline providing the normalized splits
+    :param params: Model parameters, e.g. the lstm hyperparameters
+    :return: DataFrame with one row per feature subset, horizon and model, best RMSE first per horizon
+    """
+    from my_functions import FeaturePipeline
+
+    unknown = [model for model in models if model not in FOLD_MODELS and model != "saved"]
+    if unknown:
+        raise Exception(f"Models {unknown} not recognized, use any of {list(FOLD_MODELS) + ['saved']}")
+    no_glucose = [columns for columns in subsets if "Glucose" not in columns]
+    if no_glucose:
+        raise Exception(f"Feature subsets {no_glucose} have no Glucose")
+    pipeline = pipeline or FeaturePipeline()
+    base = base_arrays(pipeline)
+    missing = sorted({col for columns in subsets for col in columns if col not in base["features"]})
+    if missing:
+        raise Exception(f"Features {missing} are not in the pipeline")
+    scaler_features = [col for col in pipeline.using_features if col != "Time"]
+    denormalize = (pipeline.min_max_scaler, scaler_features.index("Glucose"))
+
+    jobs = []
+    for columns in subsets:
+        for horizon in horizons:
+            for model in models:
+                targets = saved_models(columns, horizon, models_dir) if model == "saved" else [model]
+                jobs.extend((list(columns), horizon, target, denormalize, params) for target in targets)
+    # Jobs of the same subset next to each other, so a worker mostly reuses the subset it already built
+    workers = min(workers or os.cpu_count() or 1, max(len(jobs), 1))
+    if workers > 1:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(base, threads)) as executor:
+            rows = list(executor.map(_run_combination, jobs))
+    else:
+        _init_worker(base)
+        rows = [_run_combination(job) for job in jobs]
+
+    report = pd.DataFrame(rows)
+    if not report.empty:
+        report = report.sort_values(["horizon", "rmse"], ignore_index=True)
+    return report
+
+
+def parse_subset(text):
+    return [col.strip() for col in text.split(",") if col.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare feature subsets and horizons")
+    parser.add_argument("--subsets", nargs="+", type=parse_subset, default=DEFAULT_SUBSETS,
+                        help="Comma separated feature subsets")
+    parser.add_argument("--horizons", nargs="+", choices=list(HORIZONS), default=list(HORIZONS))
+    parser.add_argument("--models", nargs="+", default=["persistence", "linear", "saved"],
+                        choices=list(FOLD_MODELS) + ["saved"])
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default=None, help="CSV file for the report")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    report = sweep(args.subsets, args.horizons, args.models, args.workers)
+    columns = ["horizon", "features", "model", "test_windows", "rmse", "mae", "zone_a", "zone_ab"]
+    print(report[columns].to_string(index=False))
+    print(f"{len(report)} combinations in {time.perf_counter() - start:.0f}s")
+    if args.output:
+        report.to_csv(args.output, index=False)
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+from features import (derive_hour, filter_gi, combine_rapid_insulin, derive_hour_rowwise, filter_gi_rowwise,
+                      combine_rapid_insulin_rowwise)
+
+
+def glucose_frame():
+    # Unsorted index like the merged exports, GI with unknown descriptions and gaps
+    return pd.DataFrame({
+        "Time": pd.to_datetime(["2024-03-01 00:05", "2024-03-01 13:30", "2024-03-02 23:59", "2024-03-03 07:00"]),
+        "GI": ["Low", "unknown", np.nan, "Very High"],
+    }, index=[3, 0, 2, 1])
+
+
+def mysugr_frame():
+    return pd.DataFrame({
+        "Insulin (Meal)": [4.0, np.nan, np.nan, 2.5],
+        "Insulin (Correction)": [1.0, 3.0, np.nan, np.nan],
+    }, index=[10, 11, 12, 13])
+
+
+def test_derive_hour():
+    df = glucose_frame()
+    assert derive_hour(df["Time"]).equals(derive_hour_rowwise(df))
+
+
+def test_filter_gi():
+    df = glucose_frame()
+    assert filter_gi(df["GI"]).equals(filter_gi_rowwise(df))
+
+
+def test_combine_rapid_insulin():
+    df = mysugr_frame()
+    assert combine_rapid_insulin(df["Insulin (Meal)"], df["Insulin (Correction)"]).equals(
+        combine_rapid_insulin_rowwise(df))
@@ -8,6 +8,7 @@ import random
 # In another Python script (e.g., `another_script.py`)
 # from my_functions import bg_denormalize
 import numpy as np
+from windowing import examples_from_frame
 # Call the function
 
 # print(test_data)
@@ -26,8 +27,6 @@ MMOL_TO_MGDL = 18.016
 # Load the CSV
 df = pd.read_csv("all_test_data.csv")
 
-# Create a dictionary to store reshaped examples
-reshaped_data = {}
 def bg_denormalize(norm_val, unit_to="mgdl"):
     orig = norm_val * 23.979
     if unit_to == "mgdl":
@@ -35,14 +34,12 @@ def bg_denormalize(norm_val, unit_to="mgdl"):
     return orig
 
 
-random_number = random.randint(0, 10)
-# Extract data for each Example_ID and reshape
-for example_id in df["Example_ID"].unique():
-    example_data = df[df["Example_ID"] == example_id].drop(columns=["Example_ID"]).values  # Remove ID column
-    reshaped_data[example_id] = example_data.reshape(1, 20, 3)  # Reshape to (1, 20, 3)
+# Reshape all examples at once to (examples, 20, 3)
+example_ids, examples = examples_from_frame(df, width=20)
 
-# Example: Predict using the first example
-inputs = reshaped_data[random_number]  # Select Example_ID = 1
+# Example: Predict using a random example
+random_number = random.randrange(len(examples))
+inputs = examples[random_number][np.newaxis]  # Shape (1, 20, 3)
 lstm_predictions = model.predict(inputs)
 
 print("Prediction for Example 1:", (lstm_predictions)[0][0])
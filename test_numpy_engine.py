@@ -0,0 +1,28 @@
+import os
+import pandas as pd
+import pytest
+
+import numpy_engine
+from windowing import examples_from_frame
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+MODELS_DIR = os.path.join(REPO_ROOT, "models")
+KERAS_MODELS = sorted(f for f in os.listdir(MODELS_DIR) if f.endswith(".keras"))
+# Largest allowed absolute difference of the normalized predictions
+ATOL = 1e-5
+
+
+@pytest.fixture(scope="module")
+def examples():
+    _, examples = examples_from_frame(pd.read_csv(os.path.join(REPO_ROOT, "all_test_data.csv")), width=20)
+    return examples
+
+
+@pytest.mark.parametrize("model_file", KERAS_MODELS)
+def test_parity_with_tensorflow(model_file, examples):
+    pytest.importorskip("tensorflow")
+    keras_path = os.path.join(MODELS_DIR, model_file)
+    inputs = numpy_engine.parity_inputs(numpy_engine.load_model(keras_path), examples)
+    # No limit in check_parity itself, so a failure reports the difference
+    max_difference = numpy_engine.check_parity(keras_path, inputs, atol=float("inf"))
+    assert max_difference <= ATOL, f"{model_file} differs from TensorFlow by {max_difference}"
@@ -0,0 +1,182 @@
+import os
+import json
+import argparse
+import pandas as pd
+
+from data_cache import CACHE_FORMAT, read_frame, write_frame
+from evaluation import parse_model_name
+
+# Leaderboard of the keras-tuner trials in the <model name> project directories (e.g. lstm_2h_Glucose_Rapid Insulin
+# IOB_Carbohydrates). The index is one row per trial and is stored next to the dataset cache, only new or changed
+# trial.json files are read when it's updated:
+#   python trial_index.py --horizon 2h --top 5
+
+TRIAL_INDEX_PATH = os.getenv("TRIAL_INDEX_PATH",
+                             os.path.join(".cache", f"trial_index.{'parquet' if CACHE_FORMAT == 'parquet' else 'pkl'}"))
+# Metrics which are recorded as their best observation
+METRICS = ["loss", "root_mean_squared_error", "val_loss", "val_root_mean_squared_error"]
+HYPERPARAMETERS = ["units", "dropout", "learning_rate", "tuner/epochs", "tuner/initial_epoch", "tuner/bracket",
+                   "tuner/round"]
+COLUMNS = ["project", "model_type", "horizon", "features", "trial_id", "status", "score", "best_step"] + \
+          METRICS + HYPERPARAMETERS + ["artifact", "mtime_ns"]
+
+
+def project_dirs(root="."):
+    """
+    :return: Tuner project directories under root, i.e. directories with an oracle.json
+    """
+    return sorted(os.path.join(root, entry) for entry in os.listdir(root)
+                  if os.path.isfile(os.path.join(root, entry, "oracle.json")))
+
+
+def read_trial(trial_dir):
+    """
+    :return: Index row of one trial directory, without the project columns
+    """
+    path = os.path.join(trial_dir, "trial.json")
+    with open(path, "r") as f:
+        trial = json.load(f)
+    values = trial.get("hyperparameters", {}).get("values", {})
+    metrics = trial.get("metrics", {}).get("metrics", {})
+
+    row = {
+        "trial_id": trial["trial_id"],
+        "status": trial.get("status"),
+        "score": trial.get("score"),
+        "best_step": trial.get("best_step"),
+    }
+    for metric in METRICS:
+        observations = [value for observation in metrics.get(metric, {}).get("observations", [])
+                        for value in observation["value"]]
+        row[metric] = min(observations) if observations else None
+    for name in HYPERPARAMETERS:
+        row[name] = values.get(name)
+    artifact = os.path.join(trial_dir, "checkpoint.weights.h5")
+    row["artifact"] = artifact if os.path.exists(artifact) else None
+    row["mtime_ns"] = os.stat(path).st_mtime_ns
+    return row
+
+
+class TrialIndex:
+    def __init__(self, path=TRIAL_INDEX_PATH, root="."):
+        """
+        :param path: Where the index is stored
+        :param root: Directory with the tuner project directories
+        """
+        self.path = path
+        self.root = root
+        self.trials = read_frame(path) if os.path.exists(path) else pd.DataFrame(columns=COLUMNS)
+
+    def update(self):
+        """
+        Reads the trials which were added or changed since the last update and drops the removed ones
+        :return: Number of trials read
+        """
+        known = {(row.project, row.trial_id): row.mtime_ns
+                 for row in self.trials[["project", "trial_id", "mtime_ns"]].itertuples(index=False)}
+        rows, seen = [], set()
+        for project_dir in project_dirs(self.root):
+            project = os.path.basename(project_dir)
+            try:
+                model_type, horizon, features = parse_model_name(project)
+            except Exception:
+                continue
+            for entry in sorted(os.listdir(project_dir)):
+                trial_path = os.path.join(project_dir, entry, "trial.json")
+                if not entry.startswith("trial_") or not os.path.isfile(trial_path):
+                    continue
+                # trial_id isn't known before reading, the directory name carries it
+                trial_id = entry[len("trial_"):]
+                seen.add((project, trial_id))
+                if known.get((project, trial_id)) == os.stat(trial_path).st_mtime_ns:
+                    continue
+                row = read_trial(os.path.join(project_dir, entry))
+                row.update({"project": project, "model_type": model_type, "horizon": horizon,
+                            "features": "_".join(features), "trial_id": trial_id})
+                rows.append(row)
+
+        keys = list(zip(self.trials["project"], self.trials["trial_id"]))
+        changed = {(row["project"], row["trial_id"]) for row in rows}
+        keep = [key in seen and key not in changed for key in keys]
+        if rows or not all(keep):
+            self.trials = pd.concat([self.trials[keep], pd.DataFrame(rows, columns=COLUMNS)], ignore_index=True) \
+                if rows else self.trials[keep].reset_index(drop=True)
+            self.trials = self.trials.sort_values(["project", "trial_id"], ignore_index=True)
+            self.save()
+        return len(rows)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        write_frame(self.trials, tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def top(self, k=5, metric="val_root_mean_squared_error", horizon=None, model_type=None, features=None,
+            completed=True):
+        """
+        :param k: Number of trials
+        :param metric: Column to rank by, lower is better
+        :param horizon: Only trials of this horizon, e.g. "2h"
+        :param model_type: Only trials of this model type, e.g. "lstm"
+        :param features: Only trials with these input features, list or "_" joined
+        :param completed: Only completed trials
+        :return: DataFrame of the best k trials
+        """
+        trials = self.trials
+        if horizon is not None:
+            trials = trials[trials["horizon"] == horizon]
+        if model_type is not None:
+            trials = trials[trials["model_type"] == model_type]
+        if features is not None:
+            trials = trials[trials["features"] == (features if isinstance(features, str) else "_".join(features))]
+        if completed:
+            trials = trials[trials["status"] == "COMPLETED"]
+        trials = trials[trials[metric].notna()]
+        return trials.sort_values(metric, kind="stable").head(k)
+
+    def best(self, **kwargs):
+        """
+        :return: Row of the best trial, see top for the arguments
+        """
+        best = self.top(1, **kwargs)
+        if best.empty:
+            raise Exception(f"No trial matches {kwargs}")
+        return best.iloc[0]
+
+
+def load_trial_model(trial):
+    """
+    Rebuilds the model of a trial and loads its checkpoint, e.g. to save it to models/
+    :param trial: Row of the trial index
+    :return: Keras model
+    """
+    import keras_tuner as kt
+    from tuning import build_lstm_model
+
+    if trial["model_type"] != "lstm":
+        raise Exception(f"Model type {trial['model_type']} not recognized")
+    if trial["artifact"] is None:
+        raise Exception(f"Trial {trial['trial_id']} of {trial['project']} has no checkpoint")
+    hp = kt.HyperParameters()
+    hp.values.update({name: trial[name].item() if hasattr(trial[name], "item") else trial[name]
+                      for name in ["units", "dropout", "learning_rate"]})
+    model = build_lstm_model(hp)
+    with open(os.path.join(os.path.dirname(trial["artifact"]), "build_config.json"), "r") as f:
+        model.build(tuple(json.load(f)["input_shape"]))
+    model.load_weights(trial["artifact"])
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Leaderboard of the keras-tuner trials")
+    parser.add_argument("--horizon", default=None)
+    parser.add_argument("--model-type", default=None)
+    parser.add_argument("--metric", default="val_root_mean_squared_error")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    index = TrialIndex()
+    updated = index.update()
+    print(f"{len(index.trials)} trials indexed, {updated} read")
+    columns = ["project", "trial_id", args.metric, "units", "dropout", "learning_rate", "tuner/epochs"]
+    print(index.top(args.top, args.metric, args.horizon, args.model_type)[columns].to_string(index=False))
@@ -0,0 +1,210 @@
+import os
+import time
+import socket
+import hashlib
+import argparse
+import multiprocessing
+import numpy as np
+
+from windowing import HORIZONS
+
+# Parallel keras-tuner Hyperband search of the LSTM models, same search space and settings as tune_model in
+# prediction_models.ipynb. One chief process holds the oracle, every worker process runs trials on its share of
+# the cores. Trials are written to the <model name> project directory (e.g. lstm_1h_Glucose_Rapid Insulin
+# IOB_Carbohydrates), rerunning the same command resumes an interrupted search from there:
+#   python tuning.py --horizon 1h --workers 8
+
+INPUT_WIDTH = 20
+BATCH_SIZE = 16
+MAX_EPOCHS = 70
+FACTOR = 3
+HYPERBAND_ITERATIONS = 8
+PATIENCE = 2
+OBJECTIVE = "val_root_mean_squared_error"
+DEFAULT_COLUMNS = ["Glucose", "Rapid Insulin IOB", "Carbohydrates"]
+# Prepared windows shared by all the trial processes
+WINDOW_CACHE_DIR = os.getenv("WINDOW_CACHE_DIR", ".cache/windows")
+
+
+def model_name(model_type, horizon, columns):
+    """
+    Same naming as the notebook and models/, e.g. "lstm_2h_Glucose_Rapid Insulin IOB_Carbohydrates"
+    """
+    return f"{model_type}_{horizon}_{'_'.join(columns)}"
+
+
+def build_lstm_model(hp):
+    """
+    Builds RNN model with the given hyperparameters, same as build_lstm_model in the notebook
+    :param hp: Hyperparameters
+    :return: Compiled model with the given hyperparameters
+    """
+    import tensorflow as tf
+    from tensorflow import keras
+
+    model = keras.Sequential()
+    model.add(tf.keras.layers.LSTM(hp.Int("units", min_value=12, max_value=60, step=4), return_sequences=False))
+    model.add(tf.keras.layers.Dropout(hp.Float("dropout", 0, 0.15, step=0.05)))
+    model.add(tf.keras.layers.Dense(units=1))
+
+    hp_learning_rate = hp.Choice("learning_rate", values=[1e-2, 1e-3, 1e-4])
+    model.compile(loss=tf.losses.MeanSquaredError(),
+                  optimizer=tf.optimizers.Adam(learning_rate=hp_learning_rate),
+                  metrics=[tf.metrics.RootMeanSquaredError()])
+    return model
+
+
+def prepare_windows(columns, horizon, input_width=INPUT_WIDTH, pipeline=None, cache_dir=WINDOW_CACHE_DIR):
+    """
+    Builds the train and validation windows once and stores them as .npy files, which the trial processes map
+    instead of each preparing the features again. Entries are keyed on their contents, so an unchanged dataset
+    reuses the files of an earlier run.
+    :return: Directory with train_inputs.npy, train_labels.npy, val_inputs.npy and val_labels.npy
+    """
+    from my_functions import FeaturePipeline
+
+    pipeline = pipeline or FeaturePipeline()
+    arrays = {}
+    for split in ["train", "val"]:
+        inputs, labels, mask = pipeline.windows(columns, input_width, HORIZONS[horizon], split)
+        arrays[f"{split}_inputs"] = np.ascontiguousarray(inputs[mask])
+        arrays[f"{split}_labels"] = np.ascontiguousarray(labels[mask]).reshape(-1, 1)
+
+    digest = hashlib.sha1()
+    for name in sorted(arrays):
+        digest.update(name.encode())
+        digest.update(repr(arrays[name].shape).encode())
+        digest.update(arrays[name].tobytes())
+    path = os.path.join(cache_dir, f"{model_name('windows', horizon, columns)}-{digest.hexdigest()[:16]}")
+    if os.path.isdir(path):
+        return path
+
+    # Write to a temporary directory first so a crashed run never leaves a partial entry behind
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_windows(path):
+    """
+    :return: Dictionary of the arrays written by prepare_windows, memory mapped
+    """
+    return {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in ["train_inputs", "train_labels", "val_inputs", "val_labels"]}
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_tuner(project_name, directory=".", max_epochs=MAX_EPOCHS, factor=FACTOR,
+               hyperband_iterations=HYPERBAND_ITERATIONS):
+    import keras_tuner as kt
+
+    # overwrite=False reloads the oracle and the finished trials from the project directory
+    return kt.Hyperband(
+        build_lstm_model,
+        objective=kt.Objective(OBJECTIVE, direction="min"),
+        max_epochs=max_epochs,
+        factor=factor,
+        hyperband_iterations=hyperband_iterations,
+        directory=directory,
+        project_name=project_name,
+        overwrite=False,
+    )
+
+
+def _run_tuner(tuner_id, port, threads, windows_path, project_name, tuner_kwargs):
+    """
+    Entry point of the chief ("chief") and worker ("tuner<n>") processes
+    """
+    # keras-tuner reads the role from the environment, set it before anything touches keras
+    os.environ["KERASTUNER_TUNER_ID"] = tuner_id
+    os.environ["KERASTUNER_ORACLE_IP"] = "127.0.0.1"
+    os.environ["KERASTUNER_ORACLE_PORT"] = str(port)
+    os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    tuner = make_tuner(project_name, **tuner_kwargs)
+    if tuner_id == "chief":
+        # Serves the oracle until every trial is done
+        tuner.search()
+        return
+
+    arrays = load_windows(windows_path)
+    train = tf.data.Dataset.from_tensor_slices((arrays["train_inputs"], arrays["train_labels"])) \
+        .shuffle(len(arrays["train_inputs"])).batch(BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
+    val = tf.data.Dataset.from_tensor_slices((arrays["val_inputs"], arrays["val_labels"])) \
+        .batch(BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
+    early_stopping = tf.keras.callbacks.EarlyStopping(monitor="val_loss", patience=PATIENCE, mode="min")
+    tuner.search(train, epochs=tuner_kwargs.get("max_epochs", MAX_EPOCHS), validation_data=val,
+                 callbacks=[early_stopping], verbose=0)
+
+
+def tune(horizon, columns=DEFAULT_COLUMNS, workers=None, directory=".", pipeline=None, **tuner_kwargs):
+    """
+    Runs the Hyperband search with one process per worker and a shared oracle
+    :param horizon: Prediction horizon, see windowing.HORIZONS
+    :param columns: Model input columns
+    :param workers: Number of trial processes, defaults to the number of cores
+    :param directory: Where the project directory lives, the notebook used the repository root
+    :param tuner_kwargs: max_epochs, factor and hyperband_iterations
+    :return: Tuple of the best hyperparameter values and the wall time [s]
+    """
+    project_name = model_name("lstm", horizon, columns)
+    workers = workers or os.cpu_count() or 1
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    windows_path = prepare_windows(columns, horizon, pipeline=pipeline)
+    tuner_kwargs["directory"] = directory
+    port = free_port()
+
+    start = time.perf_counter()
+    # Spawned processes don't inherit TensorFlow state from this one
+    context = multiprocessing.get_context("spawn")
+    chief = context.Process(target=_run_tuner,
+                            args=("chief", port, 1, windows_path, project_name, tuner_kwargs))
+    chief.start()
+    processes = [context.Process(target=_run_tuner,
+                                 args=(f"tuner{i}", port, threads, windows_path, project_name, tuner_kwargs))
+                 for i in range(workers)]
+    try:
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        chief.join()
+    finally:
+        for process in [chief] + processes:
+            if process.is_alive():
+                process.terminate()
+    elapsed = time.perf_counter() - start
+
+    failed = [process.exitcode for process in [chief] + processes if process.exitcode]
+    if failed:
+        raise Exception(f"Tuning processes exited with codes {failed}, rerun to resume the search")
+
+    best = make_tuner(project_name, **tuner_kwargs).get_best_hyperparameters()[0]
+    return best.values, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parallel Hyperband search of the LSTM models")
+    parser.add_argument("--horizon", choices=list(HORIZONS), default="2h")
+    parser.add_argument("--columns", nargs="+", default=DEFAULT_COLUMNS)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--directory", default=".")
+    parser.add_argument("--max-epochs", type=int, default=MAX_EPOCHS)
+    parser.add_argument("--hyperband-iterations", type=int, default=HYPERBAND_ITERATIONS)
+    args = parser.parse_args()
+
+    values, elapsed = tune(args.horizon, args.columns, args.workers, args.directory,
+                           max_epochs=args.max_epochs, hyperband_iterations=args.hyperband_iterations)
+    print(f"Best hyperparameters of {model_name('lstm', args.horizon, args.columns)}: {values} ({elapsed:.0f}s)")
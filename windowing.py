@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import as_strided
+
+# Shared windowing for training, evaluation and serving. Windows are strided views over one contiguous
+# (time, features) array, building them doesn't copy any data.
+
+# Prediction horizons in samples of the 15 minute resampled series
+HORIZONS = {
+    "30min": 2,
+    "1h": 4,
+    "2h": 8,
+}
+
+# Same as WindowGenerator's input_smpl_rate, consecutive samples further apart are a gap
+MAX_SAMPLE_GAP = pd.Timedelta(minutes=17)
+
+
+def as_series_array(data, columns=None, dtype=np.float32):
+    """
+    :param data: DataFrame or array of shape (time, features)
+    :param columns: Columns to take from a DataFrame, in order
+    :return: C-contiguous array of shape (time, features)
+    """
+    if isinstance(data, pd.DataFrame):
+        data = data[columns].to_numpy() if columns is not None else data.to_numpy()
+    return np.ascontiguousarray(data, dtype=dtype)
+
+
+def sliding_windows(values, input_width):
+    """
+    :param values: C-contiguous array of shape (time, features)
+    :param input_width: Number of samples in a window
+    :return: Read-only view of shape (time - input_width + 1, input_width, features)
+    """
+    values = np.asarray(values)
+    n_windows = len(values) - input_width + 1
+    if n_windows <= 0:
+        return np.empty((0, input_width) + values.shape[1:], dtype=values.dtype)
+    return as_strided(values, shape=(n_windows, input_width) + values.shape[1:],
+                      strides=(values.strides[0],) + values.strides, writeable=False)
+
+
+def _window_has(flags, first, last):
+    """
+    For every window returns whether any of flags[first:last] (relative to the window start) is set
+    """
+    cumsum = np.concatenate([[0], np.cumsum(flags, dtype=np.int64)])
+    n_windows = len(flags) - last + 1
+    starts = np.arange(n_windows)
+    return cumsum[starts + last] - cumsum[starts + first] > 0
+
+
+def window_mask(values, input_width, shift=0, times=None, max_gap=MAX_SAMPLE_GAP, label_column=0):
+    """
+    Marks windows which can be used, i.e. without missing values and without time gaps
+    :param values: Array of shape (time, features)
+    :param input_width: Number of input samples
+    :param shift: Prediction horizon in samples, 0 for input-only windows
+    :param times: Optional timestamps of the samples, used to detect gaps
+    :param max_gap: Largest allowed distance between consecutive samples
+    :param label_column: Column of the label, only its value is checked at the label position
+    :return: Boolean array, one value per window start
+    """
+    values = np.asarray(values)
+    total = input_width + shift
+    if len(values) < total:
+        return np.zeros(0, dtype=bool)
+
+    missing = np.isnan(values).any(axis=1) if values.ndim > 1 else np.isnan(values)
+    valid = ~_window_has(missing, 0, input_width)[:len(values) - total + 1]
+    if shift:
+        label_missing = np.isnan(values[total - 1:, label_column] if values.ndim > 1 else values[total - 1:])
+        valid &= ~label_missing
+
+    if times is not None:
+        deltas = np.diff(np.asarray(times, dtype="datetime64[ns]"))
+        gaps = np.concatenate([[False], deltas > np.timedelta64(max_gap)])
+        # A gap at position i is between samples i-1 and i, so only positions after the window start count
+        valid &= ~_window_has(gaps, 1, total)
+    return valid
+
+
+def build_windows(data, input_width, shift=0, columns=None, label_column=0, times=None, max_gap=MAX_SAMPLE_GAP):
+    """
+    Builds all windows of a resampled series at once
+    :param data: DataFrame or array of shape (time, features)
+    :param input_width: Number of input samples
+    :param shift: Prediction horizon in samples (see HORIZONS), labels are shift samples after the last input
+    :param columns: Feature columns to use when data is a DataFrame
+    :param label_column: Index (within columns) of the predicted feature
+    :param times: Timestamps for gap masking, taken from the "Time" column of a DataFrame when not given
+    :param max_gap: Largest allowed distance between consecutive samples
+    :return: inputs view (N, input_width, features), labels view (N,) or None when shift is 0, and mask (N,)
+    """
+    if times is None and isinstance(data, pd.DataFrame) and "Time" in data.columns:
+        times = data["Time"].to_numpy()
+    values = as_series_array(data, columns)
+    total = input_width + shift
+    n_windows = max(len(values) - total + 1, 0)
+
+    inputs = sliding_windows(values, input_width)[:n_windows]
+    labels = None
+    if shift:
+        labels = values[total - 1:, label_column]
+    mask = window_mask(values, input_width, shift, times, max_gap, label_column)
+    return inputs, labels, mask
+
+
+def horizon_windows(data, input_width, horizon, **kwargs):
+    """
+    build_windows for a named horizon, e.g. "30min", "1h" or "2h"
+    """
+    return build_windows(data, input_width, HORIZONS[horizon], **kwargs)
+
+
+def examples_from_frame(df, width=20, id_column="Example_ID"):
+    """
+    Reshapes exported examples (rows of consecutive inputs tagged with an example id, e.g. all_test_data.csv)
+    into an array of shape (examples, width, features) without scanning the frame once per example
+    :return: Tuple of example ids and the examples array
+    """
+    ids = df[id_column].to_numpy()
+    order = np.argsort(ids, kind="stable")
+    example_ids = ids[order][::width]
+    values = df.drop(columns=[id_column]).to_numpy(dtype=np.float32)
+    if not np.array_equal(order, np.arange(len(order))):
+        values = values[order]
+    if len(values) % width or not np.array_equal(ids[order], np.repeat(example_ids, width)):
+        raise Exception(f"Every example must have exactly {width} rows")
+    return example_ids, values.reshape(len(example_ids), width, values.shape[1])